@@ -0,0 +1,94 @@
+# coding=utf-8
+
+import collections
+import json
+import os
+import shlex
+
+from esptool.targets import CHIP_DEFS
+from FirmwareSource import open_firmware, resolve_relative_path
+
+# written by ESP-IDF (idf.py build) and PlatformIO next to the binaries
+__manifest_names__ = ("flasher_args.json", "flash_project_args")
+
+# flash_mode, flash_size and flash_freq are None if the manifest doesn't set them, chip is esptool's chip name
+Manifest = collections.namedtuple("Manifest", ["images", "flash_mode", "flash_size", "flash_freq", "chip"])
+
+# ---------------------------------------------------------------------------
+
+
+class ManifestError(Exception):
+    pass
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+def is_manifest(path):
+    return os.path.basename(path.replace("\\", "/").rstrip("/")).lower() in __manifest_names__
+
+
+# Reads the images with their addresses and the flash settings from a build manifest. Image paths are relative to the
+# manifest, which may itself be a member of a bundle (see FirmwareSource).
+def load_manifest(path):
+    try:
+        with open_firmware(path) as f:
+            text = f.read().decode("utf-8")
+    except UnicodeDecodeError as e:
+        raise ManifestError("%s is not a text file: %s" % (path, e))
+    if path.lower().endswith(".json"):
+        manifest = _parse_flasher_args(path, text)
+    else:
+        manifest = _parse_flash_project_args(path, text)
+    if len(manifest.images) == 0:
+        raise ManifestError("%s doesn't list any image." % path)
+    images = [(address, resolve_relative_path(path, file)) for address, file in manifest.images]
+    return manifest._replace(images=sorted(images))
+
+
+def _parse_flasher_args(path, text):
+    try:
+        data = json.loads(text)
+        images = [(int(address, 0), file) for address, file in data["flash_files"].items()]
+    except (ValueError, KeyError, AttributeError, TypeError) as e:
+        raise ManifestError("%s is not a valid flasher_args.json: %s" % (path, e))
+    settings = data.get("flash_settings", {})
+    chip = data.get("extra_esptool_args", {}).get("chip")
+    return Manifest(images, settings.get("flash_mode"), settings.get("flash_size"), settings.get("flash_freq"),
+                    _chip_name(path, chip))
+
+
+def _parse_flash_project_args(path, text):
+    # esptool command line arguments: options with a value and address/file pairs
+    options = {}
+    images = []
+    tokens = shlex.split(text, posix=True)
+    index = 0
+    try:
+        while index < len(tokens):
+            token = tokens[index]
+            if token.startswith("--"):
+                if "=" in token:
+                    key, value = token[2:].split("=", 1)
+                    index += 1
+                else:
+                    key, value = token[2:], tokens[index + 1]
+                    index += 2
+                options[key.replace("-", "_")] = value
+            else:
+                images.append((int(token, 0), tokens[index + 1]))
+                index += 2
+    except (ValueError, IndexError) as e:
+        raise ManifestError("%s is not a valid flash_project_args file: %s" % (path, e))
+    return Manifest(images, options.get("flash_mode"), options.get("flash_size"), options.get("flash_freq"),
+                    _chip_name(path, options.get("chip")))
+
+
+def _chip_name(path, chip):
+    if chip is None or chip == "auto":
+        return None
+    if chip not in CHIP_DEFS:
+        raise ManifestError("%s is for an unknown chip: %s" % (path, chip))
+    return CHIP_DEFS[chip].CHIP_NAME
+
+# ---------------------------------------------------------------------------
@@ -0,0 +1,84 @@
+# coding=utf-8
+
+import collections
+import threading
+
+__default_max_lines__ = 2000
+
+# ---------------------------------------------------------------------------
+
+
+# What a console widget needs to do to catch up with the buffer since it was last rendered:
+# - reset: replace everything with text
+# - removed_lines: lines to remove from the start (evicted from the ring buffer)
+# - removed_chars: characters to remove from the end (the last, unterminated line that was rewritten)
+# - text: to be appended
+ConsoleChanges = collections.namedtuple("ConsoleChanges", ["reset", "removed_lines", "removed_chars", "text"])
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Bounded console contents. A carriage return rewrites the last line in place (esptool progress output) rather than
+# adding one. Changes are collected so that a widget can be updated incrementally instead of copying the whole log.
+class ConsoleBuffer:
+    def __init__(self, max_lines=__default_max_lines__):
+        self._lines = collections.deque()
+        self._max_lines = max_lines
+        self._current = ""
+        self._lock = threading.Lock()
+        # render state, see take_changes()
+        self._reset = False
+        self._rendered_lines = 0
+        self._removed_lines = 0
+        self._rendered_current = ""
+        self._dirty = False
+
+    def write(self, string):
+        string = string.replace("\r\n", "\n")
+        with self._lock:
+            segments = string.split("\n")
+            for index, segment in enumerate(segments):
+                carriage_return = segment.rfind("\r")
+                if carriage_return >= 0:
+                    self._current = segment[carriage_return + 1:]
+                else:
+                    self._current += segment
+                if index < len(segments) - 1:
+                    self._append_line(self._current + "\n")
+                    self._current = ""
+            self._dirty = True
+
+    def _append_line(self, line):
+        self._lines.append(line)
+        if len(self._lines) > self._max_lines:
+            self._lines.popleft()
+            if self._rendered_lines > 0:
+                self._rendered_lines -= 1
+                self._removed_lines += 1
+
+    def invalidate(self):
+        # the widget shows something else, the next changes must replace everything
+        with self._lock:
+            self._reset = True
+            self._dirty = True
+
+    def take_changes(self):
+        with self._lock:
+            if not self._dirty:
+                return None
+            if self._reset:
+                changes = ConsoleChanges(True, 0, 0, "".join(self._lines) + self._current)
+            else:
+                # only the newest lines are unrendered, take them from the end of the deque
+                new_lines = [self._lines[-i] for i in range(len(self._lines) - self._rendered_lines, 0, -1)]
+                changes = ConsoleChanges(False, self._removed_lines, len(self._rendered_current),
+                                         "".join(new_lines) + self._current)
+            self._reset = False
+            self._rendered_lines = len(self._lines)
+            self._removed_lines = 0
+            self._rendered_current = self._current
+            self._dirty = False
+            return changes
+
+# ---------------------------------------------------------------------------
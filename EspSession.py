@@ -0,0 +1,859 @@
+# coding=utf-8
+
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import struct
+import threading
+import zlib
+
+import esptool
+from esptool.cmds import DEFAULT_CONNECT_ATTEMPTS, detect_flash_size, erase_flash, erase_region, read_mac, \
+    write_flash, _update_image_flash_params
+from esptool.bin_image import LoadFirmwareImage
+from esptool.loader import DEFAULT_TIMEOUT, ERASE_WRITE_TIMEOUT_PER_MB, ESPLoader, timeout_per_mb
+from esptool.targets import ROM_LIST
+from esptool.util import UnsupportedCommandError, flash_size_bytes, pad_to, print_overwrite
+from FirmwareSource import open_firmware
+from PartitionTable import PartitionTableError, __partition_table_offset__, __partition_table_size__, \
+    find_partition, parse_partition_table
+from Progress import PhaseTimer, ProgressTracker
+from serial import SerialException
+from serial.tools import list_ports
+
+# Baud rate that asks the session to negotiate the fastest rate the adapter sustains
+__auto_baud__ = 0
+# Rates probed by the negotiation, fastest first. Whether a rate works depends on the USB-serial adapter.
+__auto_baud_rates__ = [3000000, 2000000, 1500000, 921600, 460800, 230400]
+# Number of bytes read back from flash to check that a negotiated rate is stable
+__baud_probe_size__ = 0x8000
+__compression_level__ = 9
+# Delta writes first compare blocks of this size and only drill down to single sectors inside differing blocks.
+__delta_block_size__ = 0x10000
+# After an erase, runs of 0xFF at least this long are left out of writes, the erased flash already reads 0xFF.
+# Shorter runs aren't worth the extra begin/finish round trip of writing the image in separate extents.
+__sparse_min_gap__ = 0x10000
+# Backups are read and written to disk in chunks of this size, the stub checks every chunk by MD5
+__read_chunk_size__ = 0x40000
+# Pooled connections nobody used for this many seconds are closed, the port is free for a serial monitor again
+__session_idle_timeout__ = 30
+
+# ---------------------------------------------------------------------------
+
+
+# Raised at the next block boundary once a job has been cancelled, the message tells how far it got
+class CancelledError(Exception):
+    pass
+
+
+# What a write got through: the (address, data) extents to write, how many bytes of each the device confirmed as
+# written and the (address, data, MD5) images to verify at the end. Outlives the session if the connection breaks,
+# see EspSession.resume_write().
+class WriteJournal:
+    def __init__(self, extents, checks, cacheable=False):
+        self.extents = extents
+        self.checks = checks
+        self.cacheable = cacheable
+        self.confirmed = [0] * len(extents)
+
+    def confirm(self, index, count):
+        self.confirmed[index] = max(self.confirmed[index], count)
+
+    def remaining(self):
+        return sum(len(data) - confirmed for (address, data), confirmed in zip(self.extents, self.confirmed))
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Keeps one esptool connection open, with the flasher stub running on the device, so that several operations can
+# be run against a board without re-opening the port, resetting, syncing and uploading the stub for each of them.
+class EspSession:
+    def __init__(self, port, baud, cache=None, baud_memory=None, progress_listener=None, cancel_event=None):
+        # port None means "first port with an Espressif device"
+        self.port = port
+        self.baud = baud
+        self.chip = None
+        self.flash_size = None
+        self._cache = cache
+        # negotiated baud rates by adapter, see adapter_id()
+        self._baud_memory = baud_memory
+        # structured progress, the listener is replaced by every job using the session
+        self.progress = ProgressTracker(progress_listener)
+        # time spent per phase since the last reset, see PhaseTimer
+        self.timer = PhaseTimer()
+        # set to cancel the running job, replaced by every job using the session like the progress listener
+        self.cancel_event = cancel_event
+        # journal of the write in progress, kept until the session is released
+        self.journal = None
+        self._esp = None
+
+    def open(self):
+        self._connect()
+        with self.timer.measure("baud_change"):
+            if self.baud == __auto_baud__:
+                self._negotiate_baud()
+            elif self.baud > self._esp._port.baudrate:
+                self._esp.change_baud(self.baud)
+        with self.timer.measure("flash_size_detect"):
+            self._configure_flash_size()
+
+    def _connect(self):
+        self.progress.begin("connect")
+        initial_baud = ESPLoader.ESP_ROM_BAUD if self.baud == __auto_baud__ else min(ESPLoader.ESP_ROM_BAUD,
+                                                                                      self.baud)
+        if self.port is None:
+            esp = self._connect_first_device(initial_baud)
+        else:
+            esp = self._connect_device(self.port, initial_baud)
+
+        if esp.secure_download_mode:
+            print("Chip is %s in Secure Download Mode" % esp.CHIP_NAME)
+        else:
+            print("Chip is %s" % esp.get_chip_description())
+            print("Features: %s" % ", ".join(esp.get_chip_features()))
+            print("Crystal is %dMHz" % esp.get_crystal_freq())
+            read_mac(esp, None)
+
+        # same as esptool.main()
+        if esp.secure_download_mode:
+            print("WARNING: Stub loader is not supported in Secure Download Mode, setting --no-stub")
+        elif not esp.IS_STUB and esp.stub_is_disabled:
+            print("WARNING: Stub loader has been disabled for compatibility, setting --no-stub")
+        else:
+            self.progress.begin("stub")
+            with self.timer.measure("stub_upload"):
+                esp = esp.run_stub()
+        if not esp.IS_STUB:
+            self._attach_flash(esp)
+
+        self.chip = esp.CHIP_NAME
+        self._esp = esp
+
+    @staticmethod
+    def _attach_flash(esp):
+        # the ROM loader doesn't enable the flash unless told to, see esptool.main()
+        if esp.CHIP_NAME != "ESP32" or esp.secure_download_mode:
+            print("Enabling default SPI flash mode...")
+            esp.flash_spi_attach(0)
+            return
+        # the ROM doesn't attach in-package flash chips
+        clk, q, d, hd, cs = esp.get_chip_spi_pads()
+        if (clk, q, d, hd, cs) != (0, 0, 0, 0, 0):
+            print("Attaching flash from eFuses' SPI pads configuration(CLK:%d, Q:%d, D:%d, HD:%d, CS:%d)..."
+                  % (clk, q, d, hd, cs))
+        else:
+            print("Enabling default SPI flash mode...")
+        esp.flash_spi_attach((hd << 24) | (cs << 18) | (d << 12) | (q << 6) | clk)
+
+    def _connect_first_device(self, initial_baud):
+        # same as esptool's auto-select
+        serial_ports = esptool.get_port_list()
+        for port in reversed(serial_ports):
+            print("Serial port %s" % port)
+            try:
+                esp = self._connect_device(port, initial_baud)
+                self.port = port
+                return esp
+            except (esptool.FatalError, OSError) as e:
+                print("%s failed to connect: %s" % (port, e))
+        raise esptool.FatalError("Could not connect to an Espressif device on any of the %d available serial ports."
+                                 % len(serial_ports))
+
+    def _connect_device(self, port, initial_baud):
+        # esptool's detect_chip() split up so that opening the port, reset & sync and chip detection are timed
+        with self.timer.measure("port_open"):
+            loader = ESPLoader(port, initial_baud)
+        try:
+            with self.timer.measure("reset_sync"):
+                loader.connect("default_reset", DEFAULT_CONNECT_ATTEMPTS, detecting=True)
+            with self.timer.measure("chip_detect"):
+                return self._detect_chip(loader, initial_baud)
+        except Exception:
+            loader._port.close()
+            raise
+
+    @staticmethod
+    def _detect_chip(loader, initial_baud):
+        esp = None
+        print("Detecting chip type...", end="")
+        try:
+            # supported by ESP32-C3 and later, works in Secure Download Mode, too
+            chip_id = loader.get_chip_id()
+            for cls in [rom for rom in ROM_LIST if rom.CHIP_NAME not in ("ESP8266", "ESP32", "ESP32-S2")]:
+                if chip_id == cls.IMAGE_CHIP_ID:
+                    esp = cls(loader._port, initial_baud)
+                    try:
+                        esp.read_reg(ESPLoader.CHIP_DETECT_MAGIC_REG_ADDR)
+                    except UnsupportedCommandError:
+                        esp.secure_download_mode = True
+                    esp._post_connect()
+                    break
+        except (UnsupportedCommandError, struct.error, esptool.FatalError) as e:
+            # ESP8266 and ESP32 are reset after an unsupported command, ESP32-S2 isn't
+            if not isinstance(e, struct.error):
+                loader.connect("default_reset", DEFAULT_CONNECT_ATTEMPTS, detecting=True, warnings=False)
+            magic_value = loader.read_reg(ESPLoader.CHIP_DETECT_MAGIC_REG_ADDR)
+            for cls in ROM_LIST:
+                if magic_value in cls.CHIP_DETECT_MAGIC_VALUE:
+                    esp = cls(loader._port, initial_baud)
+                    esp._post_connect()
+                    esp.check_chip_id()
+                    break
+        if esp is None:
+            print("")
+            raise esptool.FatalError("Failed to autodetect chip type. Probably it is unsupported by this version of "
+                                     "esptool.")
+        print(" %s" % esp.CHIP_NAME)
+        if loader.sync_stub_detected:
+            esp = esp.STUB_CLASS(esp)
+            esp.sync_stub_detected = True
+        return esp
+
+    def _negotiate_baud(self):
+        if not self._esp.IS_STUB:
+            # only the stub can change the baud rate
+            self.baud = self._esp._port.baudrate
+            return
+        adapter = adapter_id(self.port)
+        remembered = self._baud_memory.get(adapter) if adapter and self._baud_memory is not None else None
+        candidates = list(__auto_baud_rates__)
+        if remembered in candidates:
+            candidates.remove(remembered)
+            candidates.insert(0, remembered)
+
+        rate = ESPLoader.ESP_ROM_BAUD
+        for candidate in candidates:
+            self._check_cancelled()
+            try:
+                self._esp.change_baud(candidate)
+                self._probe_link()
+                rate = candidate
+                break
+            except (esptool.FatalError, SerialException, ValueError, OSError) as e:
+                # the device already switched to the new rate, only a reset brings it back
+                print("Baud rate %d is not stable (%s), falling back to a lower rate" % (candidate, e))
+                self._esp._port.close()
+                self._esp = None
+                self._connect()
+
+        self.baud = rate
+        print("Using baud rate %d" % rate)
+        if adapter and self._baud_memory is not None:
+            self._baud_memory[adapter] = rate
+
+    def _probe_link(self):
+        for _ in range(3):
+            self._esp.read_reg(ESPLoader.CHIP_DETECT_MAGIC_REG_ADDR)
+        # the stub sends an MD5 digest of the data read which esptool checks
+        self._esp.read_flash(0, __baud_probe_size__)
+
+    def _configure_flash_size(self):
+        if self._esp.secure_download_mode:
+            return
+        print("Configuring flash size...")
+        args = self._args(flash_size="detect")
+        self.flash_size = detect_flash_size(self._esp, args)
+        if self.flash_size is not None:
+            self._esp.flash_set_parameters(flash_size_bytes(self.flash_size))
+
+    def is_alive(self):
+        if self._esp is None:
+            return False
+        try:
+            self._esp.read_reg(ESPLoader.CHIP_DETECT_MAGIC_REG_ADDR)
+            return True
+        except Exception:
+            return False
+
+    def change_baud(self, baud):
+        if baud == __auto_baud__:
+            # a reused connection switches to the rate negotiated earlier for its adapter, if that's faster
+            adapter = adapter_id(self.port) if self._baud_memory is not None else None
+            remembered = self._baud_memory.get(adapter) if adapter else None
+            baud = remembered if remembered is not None and remembered > self.baud else self.baud
+        if baud != __auto_baud__ and baud != self.baud and self._esp.IS_STUB:
+            self._esp.change_baud(baud)
+            self.baud = baud
+
+    # erase_all wipes the whole chip first, erase_written only the sectors the images are written to. erase_regions
+    # are (address, size) or partition names to erase in addition, e.g. to reset NVS or SPIFFS. verify checks every
+    # image against the device's MD5 of its region afterwards, digests are known MD5s of the files by path.
+    def write_flash(self, address_files, flash_mode, erase_all=False, flash_freq="keep", flash_size=None,
+                    erase_written=False, erase_regions=(), verify=True, digests=None):
+        header = self._header_args(flash_mode, flash_freq, flash_size)
+        if self._cache is None or not self._esp.IS_STUB or self._security_features_enabled():
+            # let esptool deal with everything that the plain compressed write below doesn't cover, it erases the
+            # sectors it writes anyway
+            if not erase_all and len(erase_regions) > 0:
+                self._erase_spans(self._resolve_erase_regions(erase_regions, address_files))
+            self._write_flash_esptool(address_files, header, erase_all)
+            return
+
+        images, checks = self._load_images(address_files, header, digests)
+        extents = images
+        spans = []
+        if erase_all:
+            # a chip erase is a single command, it can only be cancelled before it starts
+            self._check_cancelled()
+            self.erase_flash()
+        else:
+            spans = self._resolve_erase_regions(erase_regions, address_files)
+        if erase_all or erase_written:
+            extents = []
+            for address, image in images:
+                image_extents = sparse_extents(address, image, self._esp.FLASH_SECTOR_SIZE)
+                extents.extend(image_extents)
+                if erase_written:
+                    # writing erases the sectors of the extents anyway, only the padding between them is erased here
+                    position = address
+                    for start, data in image_extents + [(address + len(image), b"")]:
+                        if start > position:
+                            spans.append((position, start - position))
+                        position = start + len(data)
+            skipped = sum(len(image) for address, image in images) - sum(len(data) for address, data in extents)
+            if skipped > 0:
+                print("Skipping %d bytes of erased (0xFF) padding, writing %d extent(s)..." % (skipped, len(extents)))
+        if len(spans) > 0:
+            self._erase_spans(spans)
+        # the whole images, padding included, are verified
+        journal = WriteJournal(extents, checks if verify else [], cacheable=True)
+        self.progress.begin("write", journal.remaining())
+        self._write_journal(journal)
+        if len(journal.checks) > 0:
+            self._verify_regions(journal.checks)
+
+    def _write_flash_esptool(self, address_files, header, erase_all):
+        # esptool's write can't be interrupted, a cancelled job stops before it
+        self._check_cancelled()
+        self.progress.begin("write")
+        with contextlib.ExitStack() as files:
+            args = self._args(erase_all=erase_all,
+                              addr_filename=[(address, files.enter_context(open_firmware(path)))
+                                             for address, path in address_files], **header)
+            with self.timer.measure("write"):
+                write_flash(self._esp, args)
+
+    def _security_features_enabled(self):
+        esp = self._esp
+        if esp.CHIP_NAME == "ESP8266":
+            return False
+        if esp.secure_download_mode:
+            return True
+        return esp.get_secure_boot_enabled() or esp.get_flash_encryption_enabled()
+
+    def _header_args(self, flash_mode, flash_freq, flash_size):
+        # image header settings, a build manifest may ask for a smaller flash size than the device has
+        if flash_size in (None, "keep", "detect"):
+            flash_size = self.flash_size or "keep"
+        return dict(flash_mode=flash_mode, flash_freq=flash_freq or "keep", flash_size=flash_size)
+
+    def _load_images(self, address_files, header, digests=None):
+        # returns the merged regions to write and (address, image, MD5 or None) of every image to verify
+        checks = [(address,) + self._load_image(address, path, header, digests or {})
+                  for address, path in address_files]
+        images = [(address, image) for address, image, digest in checks]
+        self._check_images(images)
+        merged = merge_regions(images, self._esp.FLASH_SECTOR_SIZE)
+        if len(merged) < len(images):
+            print("Merged %d adjacent images into %d region(s)" % (len(images), len(merged)))
+        return merged, checks
+
+    def _load_image(self, address, path, header, digests):
+        with open_firmware(path) as f:
+            data = f.read()
+        padded = pad_to(data, 4)
+        image = _update_image_flash_params(self._esp, address, self._args(**header), padded)
+        # the known digest of the file only holds if neither padding nor the header settings changed it
+        unchanged = image is padded and len(image) == len(data)
+        return image, digests.get(path) if unchanged else None
+
+    def _check_images(self, images):
+        esp = self._esp
+        flash_end = flash_size_bytes(self.flash_size) if self.flash_size else None
+        for address, image in images:
+            if flash_end is not None and address + len(image) > flash_end:
+                raise esptool.FatalError("Image (length %d) at offset 0x%x will not fit in %d bytes of flash."
+                                         % (len(image), address, flash_end))
+            if esp.CHIP_NAME == "ESP8266":
+                continue
+            try:
+                firmware = LoadFirmwareImage(esp.CHIP_NAME, io.BytesIO(image))
+            except (esptool.FatalError, struct.error, RuntimeError):
+                # not an app or bootloader image, e.g. a partition table or data
+                continue
+            if firmware.chip_id != esp.IMAGE_CHIP_ID:
+                raise esptool.FatalError("Image at offset 0x%x is not an %s image." % (address, esp.CHIP_NAME))
+
+    def write_flash_delta(self, address_files, flash_mode, flash_freq="keep", flash_size=None, erase_regions=(),
+                          verify=True, digests=None):
+        # Compares the images with the flash contents by MD5 and writes only the sectors that differ.
+        if not self._esp.IS_STUB:
+            print("Delta writes need the flasher stub, writing the whole image instead.")
+            self.write_flash(address_files, flash_mode, flash_freq=flash_freq, flash_size=flash_size,
+                             erase_regions=erase_regions, verify=verify, digests=digests)
+            return
+
+        images, checks = self._load_images(address_files, self._header_args(flash_mode, flash_freq, flash_size),
+                                           digests)
+        if len(erase_regions) > 0:
+            # erased sectors inside the images show up as changed below
+            self._erase_spans(self._resolve_erase_regions(erase_regions, address_files))
+        runs = []
+        with self.timer.measure("compare"):
+            for address, image in images:
+                runs.extend(self._find_changed_runs(address, image))
+        if len(runs) == 0:
+            print("Flash contents already match the image, nothing to write.")
+            return
+        changed = sum(len(data) for offset, data in runs)
+        total = sum(len(image) for address, image in images)
+        print("%d of %d bytes differ, writing %d region(s)..." % (changed, total, len(runs)))
+        journal = WriteJournal(runs, checks if verify else [])
+        self.progress.begin("write", changed)
+        self._write_journal(journal)
+        if len(journal.checks) > 0:
+            self._verify_regions(journal.checks)
+
+    # Continues a write that broke off, e.g. because of a USB glitch, on a new connection. What the journal recorded
+    # as written is checked by hash block by block, writing picks up at the first block that is missing or differs.
+    def resume_write(self, journal):
+        sector_size = self._esp.FLASH_SECTOR_SIZE
+        self.progress.begin("compare", sum(journal.confirmed))
+        with self.timer.measure("compare"):
+            for index, (address, data) in enumerate(journal.extents):
+                confirmed = journal.confirmed[index]
+                if address % sector_size != 0:
+                    # resuming inside the extent would erase the start of its first sector
+                    confirmed = 0
+                elif confirmed < len(data):
+                    # writing restarts at a sector boundary
+                    confirmed -= confirmed % sector_size
+                journal.confirmed[index] = self._confirmed_length(address, data, confirmed)
+        total = sum(len(data) for address, data in journal.extents)
+        print("Resuming write, %d of %d bytes are already in flash" % (total - journal.remaining(), total))
+        self.progress.begin("write", journal.remaining())
+        self._write_journal(journal)
+        if len(journal.checks) > 0:
+            self._verify_regions(journal.checks)
+
+    def _confirmed_length(self, address, data, length):
+        # length of the part of data up to length that is in flash, to the first block that differs
+        for block_start in range(0, length, __delta_block_size__):
+            self._check_cancelled()
+            block = data[block_start:min(block_start + __delta_block_size__, length)]
+            if self._differs(address + block_start, block):
+                return block_start
+            self.progress.advance(len(block))
+        return length
+
+    def _write_journal(self, journal):
+        # writes what the journal hasn't confirmed yet and records what the device confirms
+        self.journal = journal
+        with self.timer.measure("write"):
+            for index, (address, data) in enumerate(journal.extents):
+                start = journal.confirmed[index]
+                if start >= len(data):
+                    continue
+
+                def confirm(count, index=index, start=start):
+                    journal.confirm(index, start + count)
+
+                self._write_region(address + start, data[start:], cacheable=journal.cacheable and start == 0,
+                                   confirm=confirm)
+            self._finish_writing()
+
+    def _find_changed_runs(self, address, image):
+        print("Comparing image with flash contents...")
+        self.progress.begin("compare", len(image))
+        if self._esp.flash_md5sum(address, len(image)) == hashlib.md5(image).hexdigest():
+            self.progress.finish()
+            return []
+
+        # (start, end) of the image's parts in each flash sector, writing a run erases its sectors as a whole, so runs
+        # must not start or end inside a sector where the image isn't at a sector boundary
+        sector_size = self._esp.FLASH_SECTOR_SIZE
+        boundaries = sorted({0, len(image)} | set(range(-address % sector_size, len(image), sector_size)))
+        sectors = list(zip(boundaries, boundaries[1:]))
+        per_block = max(1, __delta_block_size__ // sector_size)
+        changed_sectors = []
+        for index in range(0, len(sectors), per_block):
+            self._check_cancelled()
+            block = sectors[index:index + per_block]
+            block_start, block_end = block[0][0], block[-1][1]
+            self.progress.advance(block_end - block_start)
+            if not self._differs(address + block_start, image[block_start:block_end]):
+                continue
+            if len(block) == 1:
+                changed_sectors.extend(block)
+                continue
+            for sector_start, sector_end in block:
+                if self._differs(address + sector_start, image[sector_start:sector_end]):
+                    changed_sectors.append((sector_start, sector_end))
+
+        # merge adjacent sectors so that every contiguous run is written in one go
+        runs = []
+        for sector_start, sector_end in changed_sectors:
+            if len(runs) > 0 and runs[-1][1] == sector_start:
+                runs[-1][1] = sector_end
+            else:
+                runs.append([sector_start, sector_end])
+        return [(address + start, image[start:end]) for start, end in runs]
+
+    def _compress(self, data):
+        if self._cache is None:
+            return zlib.compress(data, __compression_level__)
+        key = self._cache.key(hashlib.sha256(data).hexdigest(), __compression_level__, self.chip)
+        compressed = self._cache.get(key)
+        if compressed is None:
+            compressed = zlib.compress(data, __compression_level__)
+            self._cache.put(key, compressed)
+        else:
+            print("Using cached compressed image")
+        return compressed
+
+    def _differs(self, address, data):
+        return self._esp.flash_md5sum(address, len(data)) != hashlib.md5(data).hexdigest()
+
+    def _write_region(self, address, data, cacheable=False, confirm=None):
+        esp = self._esp
+        uncompressed_size = len(data)
+        compressed = self._compress(data) if cacheable else zlib.compress(data, __compression_level__)
+        blocks = esp.flash_defl_begin(uncompressed_size, len(compressed), address)
+        decompress = zlib.decompressobj()
+        timeout = DEFAULT_TIMEOUT
+        bytes_written = 0
+        in_flash = 0
+        for seq in range(blocks):
+            self._check_cancelled()
+            print_overwrite("Writing at 0x%08x... (%d %%)" % (address + bytes_written, 100 * (seq + 1) // blocks))
+            block = compressed[seq * esp.FLASH_WRITE_SIZE:(seq + 1) * esp.FLASH_WRITE_SIZE]
+            # feeding each compressed block into the decompressor tells how much will be written to flash
+            block_uncompressed = len(decompress.decompress(block))
+            bytes_written += block_uncompressed
+            esp.flash_defl_block(block, seq, timeout=timeout)
+            if confirm is not None:
+                # the ACK for this block may come while the previous one is still being written, the ones before
+                # that are in flash
+                confirm(in_flash)
+                in_flash = bytes_written - block_uncompressed
+            self.progress.advance(block_uncompressed)
+            # the stub ACKs a block when received and writes it while receiving the next one
+            timeout = max(DEFAULT_TIMEOUT, timeout_per_mb(ERASE_WRITE_TIMEOUT_PER_MB, block_uncompressed))
+        # a final dummy operation is only ACKed after the last block has actually been written out to flash
+        esp.read_reg(ESPLoader.CHIP_DETECT_MAGIC_REG_ADDR, timeout=timeout)
+        if confirm is not None:
+            confirm(uncompressed_size)
+        print_overwrite("Wrote %d bytes (%d compressed) at 0x%08x" % (uncompressed_size, len(compressed), address),
+                        last_line=True)
+
+    def _check_cancelled(self):
+        if self.cancel_event is None or not self.cancel_event.is_set():
+            return
+        event = self.progress.snapshot()
+        if event.phase is None:
+            raise CancelledError("Cancelled before the device was touched.")
+        if event.total > 0:
+            raise CancelledError("Cancelled during %s after %d of %d bytes." % (event.phase, event.done, event.total))
+        raise CancelledError("Cancelled during %s." % event.phase)
+
+    def _verify_regions(self, regions):
+        # (address, data, MD5 of data or None) regions, the device hashes its flash so nothing is read back
+        self.progress.begin("verify", sum(len(data) for address, data, digest in regions))
+        with self.timer.measure("verify"):
+            for address, data, digest in regions:
+                self._check_cancelled()
+                if self._esp.flash_md5sum(address, len(data)) != (digest or hashlib.md5(data).hexdigest()):
+                    raise esptool.FatalError("MD5 of data written at 0x%08x does not match data in flash!" % address)
+                self.progress.advance(len(data))
+        print("Hash of data verified.")
+
+    def _finish_writing(self):
+        # leave flash mode without rebooting, the stub keeps running
+        self._esp.flash_begin(0, 0)
+        self._esp.flash_defl_finish(False)
+
+    # Streams size bytes of flash from address (all flash from address if None) to a file chunk by chunk, the dump
+    # never sits in memory as a whole. The file only appears once all of it has been read. Returns its SHA-256.
+    def read_flash(self, path, address=0, size=None):
+        if size is None:
+            if self.flash_size is None:
+                raise esptool.FatalError("The flash size is unknown, give the size of the region to read.")
+            size = flash_size_bytes(self.flash_size) - address
+        sha256 = hashlib.sha256()
+        partial = path + ".part"
+        print("Reading %d bytes at 0x%08x to %s..." % (size, address, path))
+        self.progress.begin("read", size)
+        try:
+            with self.timer.measure("read"), open(partial, "wb") as f:
+                for offset in range(address, address + size, __read_chunk_size__):
+                    self._check_cancelled()
+                    length = min(__read_chunk_size__, address + size - offset)
+                    done = [0]
+
+                    def advance(progress, total):
+                        self.progress.advance(progress - done[0])
+                        done[0] = progress
+
+                    data = self._esp.read_flash(offset, length, advance)
+                    f.write(data)
+                    sha256.update(data)
+                    print_overwrite("Read %d of %d bytes (%d %%)" % (offset + length - address, size,
+                                                                      100 * (offset + length - address) // size))
+            os.replace(partial, path)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        print_overwrite("Read %d bytes at 0x%08x, SHA-256 %s" % (size, address, sha256.hexdigest()), last_line=True)
+        return sha256.hexdigest()
+
+    def erase_flash(self):
+        self.progress.begin("erase")
+        with self.timer.measure("erase"):
+            erase_flash(self._esp, self._args())
+        self.progress.finish()
+
+    def _erase_spans(self, spans):
+        plan = plan_erase(spans, self._esp.FLASH_SECTOR_SIZE)
+        total = sum(size for address, size in plan)
+        print("Erasing %d bytes in %d region(s)..." % (total, len(plan)))
+        self.progress.begin("erase", total)
+        with self.timer.measure("erase"):
+            for address, size in plan:
+                self._check_cancelled()
+                erase_region(self._esp, self._args(address=address, size=size))
+                self.progress.advance(size)
+        self.progress.finish()
+
+    def _resolve_erase_regions(self, regions, address_files):
+        # partition names are looked up in the partition table being written, or else in the one on the device
+        spans = [region for region in regions if isinstance(region, tuple)]
+        names = [region for region in regions if not isinstance(region, tuple)]
+        if len(names) == 0:
+            return spans
+        table = None
+        for address, path in address_files:
+            # a partition table image or a merged image spanning the table
+            if address <= __partition_table_offset__:
+                with open_firmware(path) as f:
+                    f.seek(__partition_table_offset__ - address)
+                    data = f.read(__partition_table_size__)
+                if len(parse_partition_table(data)) > 0:
+                    table = data
+        if table is None:
+            print("Reading partition table...")
+            table = self._esp.read_flash(__partition_table_offset__, __partition_table_size__)
+        partitions = parse_partition_table(table)
+        try:
+            for name in names:
+                partition = find_partition(partitions, name)
+                print("Erasing partition %s at 0x%08x (%d bytes)" % (partition.label, partition.offset, partition.size))
+                spans.append((partition.offset, partition.size))
+        except PartitionTableError as e:
+            raise esptool.FatalError(str(e))
+        return spans
+
+    def close(self):
+        if self._esp is None:
+            return
+        esp = self._esp
+        self._esp = None
+        try:
+            print("Staying in bootloader.")
+            if esp.IS_STUB:
+                esp.soft_reset(True)  # exit stub back to ROM loader
+        finally:
+            esp._port.close()
+
+    def _args(self, **kwargs):
+        # esptool's operations expect its parsed command line arguments
+        args = argparse.Namespace(chip=self.chip.lower().replace("-", "") if self.chip else "auto",
+                                  flash_size=self.flash_size or "keep", flash_mode="keep", flash_freq="keep",
+                                  addr_filename=[], erase_all=False, force=False, compress=None, no_compress=False,
+                                  no_stub=not self._esp.IS_STUB, encrypt=False, encrypt_files=None,
+                                  ignore_flash_encryption_efuse_setting=False, verify=False, diff="no")
+        for key, value in kwargs.items():
+            setattr(args, key, value)
+        return args
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Sorts (address, data) regions, rejects overlapping ones and joins directly adjacent ones so that they are written
+# and verified in one go. Writing erases whole sectors, so regions sharing a sector overlap just like esptool's
+# AddrFilenamePairAction considers them to: writing the second one would erase the tail of the first.
+def merge_regions(regions, sector_size):
+    merged = []
+    for address, data in sorted(regions, key=lambda region: region[0]):
+        if len(merged) > 0:
+            previous_address, previous_data = merged[-1]
+            previous_end = previous_address + len(previous_data)
+            if address == previous_end:
+                merged[-1] = (previous_address, previous_data + data)
+                continue
+            if address < previous_end:
+                raise esptool.FatalError("Image at 0x%08x overlaps the one at 0x%08x (which ends at 0x%08x)."
+                                         % (address, previous_address, previous_end))
+            if address // sector_size == (previous_end - 1) // sector_size:
+                raise esptool.FatalError("Image at 0x%08x shares the flash sector at 0x%08x with the one at 0x%08x "
+                                         "(which ends at 0x%08x)." % (address, address - address % sector_size,
+                                                                      previous_address, previous_end))
+        merged.append((address, data))
+    return merged
+
+
+# Rounds (address, size) spans out to whole sectors and merges overlapping and adjacent ones, erase_region() only
+# takes sector-aligned regions
+def plan_erase(spans, sector_size):
+    plan = []
+    for address, size in sorted(spans):
+        start = address - address % sector_size
+        end = -(-(address + size) // sector_size) * sector_size
+        if len(plan) > 0 and start <= plan[-1][1]:
+            plan[-1][1] = max(plan[-1][1], end)
+        else:
+            plan.append([start, end])
+    return [(start, end - start) for start, end in plan if end > start]
+
+
+# Splits an image into the (address, data) extents that have to be written to erased flash. Sector-aligned runs of
+# 0xFF of at least min_gap bytes are left out, shorter ones stay in their extent.
+def sparse_extents(address, data, sector_size, min_gap=__sparse_min_gap__):
+    blank = b"\xff" * sector_size
+    extents = []
+    start = 0
+    gap_start = None
+    # the first sector boundary in the image, gaps never start before it
+    offset = -address % sector_size
+    while offset < len(data):
+        end = offset + sector_size
+        if data[offset:end] == blank[:len(data[offset:end])]:
+            if gap_start is None:
+                gap_start = offset
+        elif gap_start is not None:
+            if offset - gap_start >= min_gap:
+                extents.append((start, gap_start))
+                start = offset
+            gap_start = None
+        offset = end
+    if gap_start is not None and len(data) - gap_start >= min_gap:
+        extents.append((start, gap_start))
+        start = len(data)
+    if start < len(data):
+        extents.append((start, len(data)))
+    return [(address + start, data[start:end]) for start, end in extents if end > start]
+
+
+# Identifies the USB-serial adapter behind a port by vendor ID, product ID and serial number
+def adapter_id(port):
+    for info in list_ports.comports():
+        if info.device == port and info.vid is not None:
+            return "%04X:%04X:%s" % (info.vid, info.pid, info.serial_number or "")
+    return None
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Open sessions by port so that a follow-up job on the same board skips connect, reset, sync and stub upload. A
+# session that isn't picked up again within idle_timeout seconds is closed, leaving the board in the bootloader like
+# esptool's --after no_reset.
+class SessionPool:
+    def __init__(self, cache=None, baud_memory=None, idle_timeout=__session_idle_timeout__):
+        self._cache = cache
+        self._baud_memory = baud_memory
+        self._idle_timeout = idle_timeout
+        self._sessions = {}
+        # port -> timer closing its idle session
+        self._idle_timers = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, port, baud, progress_listener=None, cancel_event=None):
+        if port is None:
+            # auto-select scans every port, idle connections hold theirs open exclusively and would be skipped
+            self.close_all()
+        with self._lock:
+            session = self._sessions.pop(port, None)
+            self._cancel_idle_timer(port)
+        if session is not None:
+            if session.is_alive():
+                print("Reusing open connection on %s" % session.port)
+                session.progress.listener = progress_listener
+                session.cancel_event = cancel_event
+                session.change_baud(baud)
+                return session
+            self._discard(session)
+        session = EspSession(port, baud, self._cache, self._baud_memory, progress_listener, cancel_event)
+        try:
+            session.open()
+        except Exception:
+            # e.g. cancelled or a failed stub upload, the port must not stay open
+            self._discard(session)
+            raise
+        return session
+
+    def release(self, session, discard=False):
+        session.progress.listener = None
+        session.cancel_event = None
+        session.journal = None
+        session.timer.reset()
+        if discard:
+            self._discard(session)
+            return
+        with self._lock:
+            previous = self._sessions.pop(session.port, None)
+            self._sessions[session.port] = session
+            self._cancel_idle_timer(session.port)
+            timer = threading.Timer(self._idle_timeout, self._expire, (session,))
+            timer.daemon = True
+            timer.start()
+            self._idle_timers[session.port] = timer
+        if previous is not None and previous is not session:
+            self._discard(previous)
+
+    def close(self, port):
+        # e.g. the device was unplugged, the next board on the port gets a new connection
+        with self._lock:
+            session = self._sessions.pop(port, None)
+            self._cancel_idle_timer(port)
+        if session is not None:
+            self._discard(session)
+
+    def close_all(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+            for port in list(self._idle_timers):
+                self._cancel_idle_timer(port)
+        for session in sessions:
+            self._discard(session)
+
+    def _expire(self, session):
+        with self._lock:
+            if self._sessions.get(session.port) is not session:
+                # picked up by a job in the meantime
+                return
+            del self._sessions[session.port]
+            self._idle_timers.pop(session.port, None)
+            # under the lock so that a job acquiring the port waits for it to be closed
+            print("Closing idle connection on %s" % session.port)
+            self._discard(session)
+
+    def _cancel_idle_timer(self, port):
+        timer = self._idle_timers.pop(port, None)
+        if timer is not None:
+            timer.cancel()
+
+    @staticmethod
+    def _discard(session):
+        try:
+            session.close()
+        except Exception:
+            # the device is most likely gone already, e.g. unplugged
+            pass
+
+# ---------------------------------------------------------------------------
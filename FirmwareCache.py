@@ -0,0 +1,76 @@
+# coding=utf-8
+
+import os
+import threading
+
+__default_size_limit__ = 256 * 1024 * 1024
+
+# ---------------------------------------------------------------------------
+
+
+# Compressed firmware payloads on disk, keyed by image SHA-256, compression level and chip. Re-flashing an image
+# that was flashed before then skips compressing it. The file modification time records the last use so that the
+# least recently used payloads are evicted once the cache grows beyond its size limit.
+class FirmwareCache:
+    def __init__(self, directory, size_limit=__default_size_limit__):
+        self._directory = directory
+        self._size_limit = size_limit
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(image_sha256, level, chip):
+        return "%s-%d-%s" % (image_sha256, level, chip.lower().replace("-", ""))
+
+    def get(self, key):
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.utime(path)
+            except OSError:
+                return None
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        with self._lock:
+            try:
+                os.makedirs(self._directory, exist_ok=True)
+                temp_path = "%s.%d.tmp" % (path, threading.get_ident())
+                with open(temp_path, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+                self._evict()
+            except OSError as e:
+                # the cache is an optimization only, flashing must not fail because of it
+                print("Could not cache compressed firmware: %s" % e)
+
+    def clear(self):
+        with self._lock:
+            for name, size, last_used in self._entries():
+                os.remove(os.path.join(self._directory, name))
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for name, size, last_used in entries)
+        while total > self._size_limit and len(entries) > 0:
+            name, size, last_used = entries.pop(0)
+            os.remove(os.path.join(self._directory, name))
+            total -= size
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self._directory):
+            return entries
+        for name in os.listdir(self._directory):
+            if not name.endswith(".zlib"):
+                continue
+            stat = os.stat(os.path.join(self._directory, name))
+            entries.append((name, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + ".zlib")
+
+# ---------------------------------------------------------------------------
@@ -0,0 +1,177 @@
+# coding=utf-8
+
+import collections
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from FirmwareImage import ImageInfo, InvalidImageError, NotAnImageError, inspect_image
+from FirmwareSource import firmware_stat, open_firmware, split_archive_path
+
+__hash_chunk_size__ = 0x10000
+# NodeMCU embeds its version and the list of compiled-in modules in the banner it prints on boot
+__nodemcu_version_pattern__ = re.compile(rb"NodeMCU (?:ESP32 )?(\d+(?:\.\d+)+)")
+__nodemcu_modules_pattern__ = re.compile(rb"modules: ([\w,]+)")
+
+CatalogEntry = collections.namedtuple("CatalogEntry", ["path", "size", "mtime", "sha256", "image", "error",
+                                                       "nodemcu_version", "modules", "last_used", "md5"])
+
+__schema__ = """
+CREATE TABLE IF NOT EXISTS firmware (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL,
+    chip TEXT,
+    image_offset INTEGER,
+    flash_mode TEXT,
+    flash_size TEXT,
+    flash_freq TEXT,
+    segments INTEGER,
+    error TEXT,
+    nodemcu_version TEXT,
+    modules TEXT,
+    last_used REAL,
+    md5 TEXT
+)
+"""
+# columns added after the first release, older catalogs get them on opening
+__added_columns__ = [("md5", "TEXT")]
+__columns__ = ["path", "size", "mtime", "sha256", "chip", "image_offset", "flash_mode", "flash_size", "flash_freq",
+               "segments", "error", "nodemcu_version", "modules", "last_used", "md5"]
+
+# ---------------------------------------------------------------------------
+
+
+# SQLite index of the firmware files seen so far: content hash, image header and NodeMCU version and modules. A file is
+# only read again if its size or modification time changed, so checking a previously used image or rescanning a
+# directory full of builds costs one stat() per file.
+class FirmwareCatalog:
+    def __init__(self, file_path):
+        self._db = sqlite3.connect(file_path, check_same_thread=False)
+        self._db.execute(__schema__)
+        existing = [row[1] for row in self._db.execute("PRAGMA table_info(firmware)")]
+        for name, type_ in __added_columns__:
+            if name not in existing:
+                self._db.execute("ALTER TABLE firmware ADD COLUMN %s %s" % (name, type_))
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def lookup(self, path):
+        path = os.path.abspath(path)
+        size, mtime = firmware_stat(path)
+        with self._lock:
+            row = self._db.execute("SELECT %s FROM firmware WHERE path = ?" % ", ".join(__columns__),
+                                   (path,)).fetchone()
+        if row is not None and row[1] == size and row[2] == mtime and row[-1] is not None:
+            return self._entry(row)
+        return self._index(path, size, mtime, row[-2] if row is not None else None)
+
+    def scan(self, directory, extensions=(".bin",)):
+        # returns the number of files (re-)indexed, unchanged files are skipped
+        indexed = 0
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                if not name.lower().endswith(extensions):
+                    continue
+                path = os.path.abspath(os.path.join(root, name))
+                stat = os.stat(path)
+                with self._lock:
+                    row = self._db.execute("SELECT size, mtime, last_used, md5 FROM firmware WHERE path = ?",
+                                           (path,)).fetchone()
+                if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime or row[3] is None:
+                    self._index(path, stat.st_size, stat.st_mtime, row[2] if row is not None else None)
+                    indexed += 1
+        return indexed
+
+    def mark_used(self, path):
+        with self._lock:
+            self._db.execute("UPDATE firmware SET last_used = ? WHERE path = ?", (time.time(), os.path.abspath(path)))
+            self._db.commit()
+
+    def recent(self, limit=10):
+        # most recently used images that still exist
+        with self._lock:
+            rows = self._db.execute("SELECT %s FROM firmware WHERE last_used IS NOT NULL ORDER BY last_used DESC"
+                                    % ", ".join(__columns__)).fetchall()
+        entries = []
+        for row in rows:
+            if os.path.exists(split_archive_path(row[0])[0]):
+                entries.append(self._entry(row))
+            if len(entries) == limit:
+                break
+        return entries
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _index(self, path, size, mtime, last_used):
+        sha256 = hashlib.sha256()
+        # what the device reports for the flash region the file is written to, see EspSession._verify_regions()
+        md5 = hashlib.md5()
+        version = None
+        modules = None
+        tail = b""
+        with open_firmware(path) as f:
+            for chunk in iter(lambda: f.read(__hash_chunk_size__), b""):
+                sha256.update(chunk)
+                md5.update(chunk)
+                # the banner may straddle two chunks
+                window = tail + chunk
+                version = version or _search(__nodemcu_version_pattern__, window)
+                modules = modules or _search(__nodemcu_modules_pattern__, window)
+                tail = chunk[-256:]
+        try:
+            image = inspect_image(path)
+            error = None
+        except NotAnImageError:
+            # plain data, e.g. a partition table
+            image = None
+            error = None
+        except InvalidImageError as e:
+            image = None
+            error = str(e)
+        row = (path, size, mtime, sha256.hexdigest(),
+               image.chip if image else None, image.offset if image else None,
+               image.flash_mode if image else None, image.flash_size if image else None,
+               image.flash_freq if image else None, image.segments if image else None,
+               error, version, modules, last_used, md5.hexdigest())
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO firmware (%s) VALUES (%s)"
+                             % (", ".join(__columns__), ", ".join("?" * len(__columns__))), row)
+            self._db.commit()
+        return self._entry(row)
+
+    @staticmethod
+    def _entry(row):
+        (path, size, mtime, sha256, chip, offset, flash_mode, flash_size, flash_freq, segments, error, version,
+         modules, last_used, md5) = row
+        image = None
+        if chip is not None:
+            image = ImageInfo(chip, offset, flash_mode, flash_size, flash_freq, segments, size)
+        return CatalogEntry(path, size, mtime, sha256, image, error, version, modules, last_used, md5)
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+def describe_entry(entry):
+    text = os.path.basename(entry.path)
+    if entry.nodemcu_version is not None:
+        text += ", NodeMCU %s" % entry.nodemcu_version
+    if entry.image is not None:
+        text += ", %s" % entry.image.chip
+    if entry.modules is not None:
+        text += " (%s)" % entry.modules
+    return text
+
+
+def _search(pattern, data):
+    match = pattern.search(data)
+    return match.group(1).decode("ascii") if match else None
+
+# ---------------------------------------------------------------------------
@@ -0,0 +1,145 @@
+# coding=utf-8
+
+import collections
+import os
+import struct
+
+import esptool
+from esptool.bin_image import LoadFirmwareImage
+from esptool.cmds import FLASH_MODES
+from esptool.loader import ESPLoader
+from esptool.targets import CHIP_DEFS, ROM_LIST
+from esptool.util import flash_size_bytes
+from FirmwareSource import open_firmware
+
+# ESP8266 images start with the load address of their first segment where later chips have their extended header
+__esp8266_address_range__ = (0x3FF00000, 0x40300000)
+
+ImageInfo = collections.namedtuple("ImageInfo", ["chip", "offset", "flash_mode", "flash_size", "flash_freq",
+                                                 "segments", "length"])
+
+# ---------------------------------------------------------------------------
+
+
+class InvalidImageError(Exception):
+    pass
+
+
+# The file doesn't start with an image header at all, e.g. a partition table or a file system image
+class NotAnImageError(InvalidImageError):
+    pass
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Parses the header, segment table, checksum and appended SHA-256 of the ESP image in a file without any serial I/O,
+# so that a wrong or damaged file is rejected before a device is erased. offset is where the image starts in the file,
+# None looks at the start and, for merged images padded with 0xFF, at the chips' bootloader offsets.
+def inspect_image(path, offset=None):
+    with open_firmware(path) as f:
+        file_size = f.seek(0, os.SEEK_END)
+        if offset is None:
+            offset = _find_image_offset(f)
+        f.seek(offset)
+        header = f.read(16)
+        if len(header) < 16 or header[0] not in (ESPLoader.ESP_IMAGE_MAGIC, 0xEA):
+            raise NotAnImageError("%s is not an ESP firmware image (no 0x%02X magic byte at 0x%x)."
+                                    % (path, ESPLoader.ESP_IMAGE_MAGIC, offset))
+        rom = _detect_rom(header)
+        f.seek(offset)
+        try:
+            image = LoadFirmwareImage(rom.CHIP_NAME, f)
+        except (esptool.FatalError, struct.error, RuntimeError, KeyError) as e:
+            raise InvalidImageError("%s is not a valid %s image: %s" % (path, rom.CHIP_NAME, e))
+
+    if image.checksum != image.calculate_checksum():
+        raise InvalidImageError("%s is damaged, its checksum is 0x%02x but the segments add up to 0x%02x."
+                                % (path, image.checksum, image.calculate_checksum()))
+    if getattr(image, "append_digest", False) and image.stored_digest != image.calc_digest:
+        raise InvalidImageError("%s is damaged, the appended SHA-256 doesn't match its contents." % path)
+
+    flash_mode = _key_for(FLASH_MODES, image.flash_mode)
+    flash_size = _key_for(rom.FLASH_SIZES, image.flash_size_freq & 0xF0)
+    flash_freq = _key_for(rom.FLASH_FREQUENCY, image.flash_size_freq & 0x0F)
+    return ImageInfo(rom.CHIP_NAME, offset, flash_mode, flash_size, flash_freq, len(image.segments), file_size)
+
+
+# Checks an image against the settings it is going to be written with. Returns warnings, raises InvalidImageError
+# for images that can't work.
+def check_image(info, flash_mode=None, chip=None):
+    warnings = []
+    if chip is not None and info.chip != chip:
+        raise InvalidImageError("The image is for %s, not %s." % (info.chip, chip))
+    if info.flash_size is None:
+        warnings.append("The image header has no valid flash size.")
+    elif info.length > flash_size_bytes(info.flash_size.split("-")[0]):
+        # the header is updated with the detected flash size when writing, which is checked against the image then
+        warnings.append("The image (%d bytes) is larger than the %s flash its header declares."
+                        % (info.length, info.flash_size))
+    if info.flash_mode is None:
+        warnings.append("The image header has no valid flash mode.")
+    elif flash_mode is not None and info.flash_mode != flash_mode:
+        warnings.append("The image header says flash mode %s, it will be written with %s."
+                        % (info.flash_mode, flash_mode))
+    return warnings
+
+
+# Rejects (address, size, name) regions that overlap each other or share a flash sector, writing one erases the whole
+# sector and with it the other's bytes there. Directly adjacent regions are written in one go (see
+# EspSession.merge_regions()) and are fine.
+def check_layout(regions):
+    sector_size = ESPLoader.FLASH_SECTOR_SIZE
+    previous = None
+    for address, size, name in sorted(regions):
+        if previous is not None:
+            # images are padded to 4 bytes when they are written
+            previous_end = previous[0] + -(-previous[1] // 4) * 4
+            if address < previous_end:
+                raise InvalidImageError("%s at 0x%x overlaps %s at 0x%x-0x%x."
+                                        % (name, address, previous[2], previous[0], previous_end))
+            if address != previous_end and address // sector_size == (previous_end - 1) // sector_size:
+                raise InvalidImageError("%s at 0x%x shares the flash sector at 0x%x with %s at 0x%x-0x%x, images "
+                                        "must start in a sector of their own."
+                                        % (name, address, address - address % sector_size, previous[2],
+                                           previous[0], previous_end))
+        previous = (address, size, name)
+
+
+def describe_image(info):
+    return "%s image, %d segments, flash mode %s, %s at %s" % (info.chip, info.segments, info.flash_mode,
+                                                               info.flash_size, info.flash_freq)
+
+
+def _find_image_offset(f):
+    for offset in sorted({0} | {rom.BOOTLOADER_FLASH_OFFSET for rom in ROM_LIST}):
+        f.seek(offset)
+        first = f.read(1)
+        if len(first) == 0:
+            break
+        if first[0] != 0xFF:
+            return offset
+    return 0
+
+
+def _detect_rom(header):
+    if header[0] == 0xEA:
+        # ESP8266 "version 2" image
+        return CHIP_DEFS["esp8266"]
+    first_address = struct.unpack("<I", header[8:12])[0]
+    if __esp8266_address_range__[0] <= first_address < __esp8266_address_range__[1]:
+        return CHIP_DEFS["esp8266"]
+    chip_id = struct.unpack("<H", header[12:14])[0]
+    for rom in ROM_LIST:
+        if rom.CHIP_NAME != "ESP8266" and rom.IMAGE_CHIP_ID == chip_id:
+            return rom
+    raise InvalidImageError("Unknown chip ID %d in the image header." % chip_id)
+
+
+def _key_for(mapping, value):
+    for key, mapped in mapping.items():
+        if mapped == value:
+            return key
+    return None
+
+# ---------------------------------------------------------------------------
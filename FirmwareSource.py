@@ -0,0 +1,126 @@
+# coding=utf-8
+
+import contextlib
+import errno
+import os
+import posixpath
+import re
+import tarfile
+import zipfile
+
+__archive_suffixes__ = (".zip", ".tar.gz", ".tgz", ".tar")
+__image_suffixes__ = (".bin",)
+# a member of an archive is addressed like a file in a directory named like the archive, e.g. build.zip/app.bin
+__archive_path_pattern__ = re.compile(r"^(.+?(?:%s))[/\\](.+)$"
+                                      % "|".join(re.escape(suffix) for suffix in __archive_suffixes__), re.IGNORECASE)
+
+# ---------------------------------------------------------------------------
+
+
+# Firmware files may be plain files or members of zip and tar(.gz) bundles. Members are read straight from the archive,
+# nothing is extracted to disk and the archive is never loaded as a whole.
+
+def is_archive(path):
+    return path.lower().endswith(__archive_suffixes__) and os.path.isfile(path)
+
+
+def split_archive_path(path):
+    # (archive, member) for a member of an archive, (path, None) for plain files
+    if os.path.isfile(path):
+        return path, None
+    match = __archive_path_pattern__.match(path)
+    if match is None or not os.path.isfile(match.group(1)):
+        return path, None
+    return match.group(1), match.group(2).replace("\\", "/")
+
+
+def join_archive_path(archive, member):
+    return "%s/%s" % (archive, member)
+
+
+def list_members(archive, suffixes=__image_suffixes__):
+    with _open_archive(archive) as bundle:
+        if isinstance(bundle, zipfile.ZipFile):
+            names = [info.filename for info in bundle.infolist() if not info.is_dir()]
+        else:
+            names = [info.name for info in bundle.getmembers() if info.isfile()]
+    return [name for name in names if name.lower().endswith(suffixes)]
+
+
+# Resolves an archive to the member with one of the preferred names (e.g. a build manifest) or to its only image,
+# anything else is returned as is
+def resolve_firmware_path(path, preferred_names=()):
+    if not is_archive(path):
+        return path
+    preferred = [name for name in list_members(path, preferred_names) if posixpath.basename(name) in preferred_names]
+    if len(preferred) > 0:
+        # the one closest to the root of the archive
+        return join_archive_path(path, min(preferred, key=lambda name: (name.count("/"), name)))
+    members = list_members(path)
+    if len(members) != 1:
+        raise OSError(errno.EINVAL, "%s contains %d images, pick one of them as %s"
+                      % (path, len(members), join_archive_path(path, "<image>")))
+    return join_archive_path(path, members[0])
+
+
+# Path of a file referenced relative to another one, e.g. by a build manifest, works inside archives, too
+def resolve_relative_path(path, relative):
+    archive, member = split_archive_path(path)
+    if member is None:
+        return os.path.join(os.path.dirname(path), relative)
+    return join_archive_path(archive, posixpath.normpath(posixpath.join(posixpath.dirname(member), relative)))
+
+
+@contextlib.contextmanager
+def open_firmware(path):
+    # seekable binary file object with a name, plain file or archive member
+    archive, member = split_archive_path(path)
+    if member is None:
+        with open(path, "rb") as f:
+            yield f
+        return
+    with _open_archive(archive) as bundle:
+        try:
+            if isinstance(bundle, zipfile.ZipFile):
+                f = bundle.open(member)
+            else:
+                f = bundle.extractfile(member)
+        except KeyError:
+            f = None
+        if f is None:
+            raise OSError(errno.ENOENT, "No image %s in %s" % (member, archive))
+        with f:
+            yield f
+
+
+def firmware_stat(path):
+    # (size, mtime) of the image, an archive member has the archive's mtime
+    archive, member = split_archive_path(path)
+    if member is None:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+    # the size is taken from the archive's index, seeking to the end of a member would decompress it
+    with _open_archive(archive) as bundle:
+        try:
+            if isinstance(bundle, zipfile.ZipFile):
+                size = bundle.getinfo(member).file_size
+            else:
+                size = bundle.getmember(member).size
+        except KeyError:
+            raise OSError(errno.ENOENT, "No image %s in %s" % (member, archive))
+    return size, os.stat(archive).st_mtime
+
+
+@contextlib.contextmanager
+def _open_archive(archive):
+    try:
+        if archive.lower().endswith(".zip"):
+            bundle = zipfile.ZipFile(archive)
+        else:
+            bundle = tarfile.open(archive, "r:*")
+    except (zipfile.BadZipFile, tarfile.TarError) as e:
+        raise OSError(errno.EINVAL, "%s is not a valid archive: %s" % (archive, e))
+    with bundle:
+        yield bundle
+
+# ---------------------------------------------------------------------------
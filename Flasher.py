@@ -0,0 +1,466 @@
+# coding=utf-8
+
+import sys
+import os
+import threading
+import json
+import copy
+import re
+import time
+import esptool
+from EspSession import CancelledError, adapter_id, __auto_baud__
+from FirmwareImage import InvalidImageError, NotAnImageError, check_image, check_layout, describe_image, \
+    inspect_image
+from FirmwareSource import firmware_stat
+from PartitionTable import parse_region
+from OutputRouter import route_output
+from serial import SerialException
+from serial.tools import list_ports
+
+# Everything needed to flash a device without the GUI. Must not import wx (or images) so that the headless entry
+# point starts fast and works without a display.
+
+__version__ = "5.1.0"
+__auto_select__ = "Auto-select"
+__all_espressif__ = "All Espressif devices"
+__multiple_ports__ = "Multiple ports..."
+# USB vendor IDs of Espressif's native USB and of the USB-serial bridges commonly found on ESP boards:
+# Espressif, Silicon Labs CP210x, WCH CH340/CH9102, FTDI
+__espressif_usb_vids__ = [0x303A, 0x10C4, 0x1A86, 0x0403]
+__supported_baud_rates__ = [9600, 57600, 74880, 115200, 230400, 460800, 921600]
+__flash_modes__ = ["qio", "dio", "dout"]
+
+# serializes appending to the timings file, see record_timings()
+_timings_lock = threading.Lock()
+# A job whose connection breaks while writing waits this long for the device to come back and resumes the write,
+# at most this many times
+__reconnect_timeout__ = 30
+__resume_attempts__ = 3
+# ports with a running job in this process, see claim_port()
+_busy_ports = set()
+_busy_ports_lock = threading.Lock()
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+class FlashingThread(threading.Thread):
+    # raise_errors re-raises failures after reporting them so that the thread's traceback shows up, headless mode
+    # reports them as a status line only
+    def __init__(self, parent, config, session_pool, cancel_event=None, raise_errors=True):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._parent = parent
+        self._config = config
+        self._session_pool = session_pool
+        # replaced by a new connection if the job resumes after the connection broke
+        self._session = None
+        # anything with is_set() and set(), e.g. a multiprocessing manager's event for jobs in worker processes
+        self._cancel_event = cancel_event if cancel_event is not None else threading.Event()
+        self._raise_errors = raise_errors
+        self.succeeded = False
+
+    def cancel(self):
+        # the job stops at the next block boundary and closes the port
+        self._cancel_event.set()
+
+    def run(self):
+        if not claim_port(self._config.port):
+            self._parent.report_status(self._config.port, "Failed: another job is using %s" % self._config.port)
+            return
+        try:
+            # everything printed by this thread, esptool included, goes to the job's own sink
+            with route_output(self._parent.output_sink(self._config.port)):
+                self._run()
+        finally:
+            release_port(self._config.port)
+
+    def _run(self):
+        self.succeeded = False
+        backup = self._config.backup_path is not None
+        self._parent.report_status(self._config.port, "Backing up" if backup else "Flashing")
+        port = None if self._config.port.startswith(__auto_select__) else self._config.port
+        self._session = None
+        failed = True
+        try:
+            if self._cancel_event.is_set():
+                raise CancelledError("Cancelled before the job started.")
+            # backups are read at the fastest rate the adapter sustains whatever rate flashing uses
+            baud = __auto_baud__ if backup else self._config.baud
+            self._session = self._session_pool.acquire(port, baud, self._report_progress, self._cancel_event)
+            if backup:
+                self._backup(self._session)
+            else:
+                self._flash_resuming(port, baud)
+            failed = False
+            self._parent.report_status(self._config.port, "Done")
+            self.succeeded = True
+        except CancelledError as e:
+            print("\n%s" % e)
+            if not backup:
+                print("The flash contents may be incomplete, the device needs to be flashed again.")
+            self._parent.report_status(self._config.port, str(e))
+        except SerialException as e:
+            self._parent.report_status(self._config.port, "Failed: %s" % e)
+            self._parent.report_error(self._config.port, str(e))
+            if self._raise_errors:
+                raise e
+        except Exception as e:
+            self._parent.report_status(self._config.port, "Failed: %s" % e)
+            if self._raise_errors:
+                raise e
+        finally:
+            if self._session is not None:
+                self._report_timings(self._session)
+                # keep the connection (and the stub) for the next job unless its state is unknown or the port was
+                # picked by auto-select
+                self._session_pool.release(self._session, discard=failed or port is None)
+                self._session = None
+
+    def _flash_resuming(self, port, baud):
+        # A connection that breaks while writing, e.g. because of a USB glitch, doesn't start the job over. Once the
+        # device is back the write continues from where it had got to, see EspSession.resume_write().
+        journal = None
+        attempt = 0
+        while True:
+            try:
+                if journal is None:
+                    self._flash(self._session)
+                else:
+                    self._session.resume_write(journal)
+                break
+            except SerialException as e:
+                # nothing to resume if the write hadn't started, the job is then run again as a whole
+                journal = self._session.journal or journal
+                attempt += 1
+                if port is None or attempt > __resume_attempts__:
+                    raise
+                print("\nConnection lost (%s), reconnecting..." % e)
+                self._parent.report_status(self._config.port, "Reconnecting")
+                durations = dict(self._session.timer.durations)
+                self._session_pool.release(self._session, discard=True)
+                self._session = None
+                self._session = self._reconnect(port, baud)
+                self._session.timer.add(durations)
+                self._parent.report_status(self._config.port, "Resuming" if journal is not None else "Flashing")
+
+        # The last line printed by esptool is "Staying in bootloader." -> some indication that the process is
+        # done is needed
+        print("\nFirmware successfully flashed. Unplug/replug or reset device \nto switch back to normal boot "
+              "mode.")
+
+    def _reconnect(self, port, baud):
+        deadline = time.time() + __reconnect_timeout__
+        while True:
+            if self._cancel_event.is_set():
+                raise CancelledError("Cancelled while reconnecting.")
+            try:
+                return self._session_pool.acquire(port, baud, self._report_progress, self._cancel_event)
+            except (SerialException, esptool.FatalError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(1)
+
+    def _flash(self, session):
+        images = self._config.flash_images()
+        for address, path in images:
+            print("Writing %s at 0x%05x" % (path, address))
+        print("Flash mode %s%s\n" % (self._config.mode, self._config.describe_erase()))
+        header = dict(flash_freq=self._config.flash_freq, flash_size=self._config.flash_size)
+        erase_regions = [parse_region(region) for region in self._config.erase_regions]
+        verify = dict(verify=self._config.verify, digests=self._config.digests)
+        if self._config.delta and not (self._config.erase_before_flash or self._config.erase_written):
+            session.write_flash_delta(images, self._config.mode, erase_regions=erase_regions, **header, **verify)
+        else:
+            session.write_flash(images, self._config.mode, erase_all=self._config.erase_before_flash,
+                                erase_written=self._config.erase_written, erase_regions=erase_regions, **header,
+                                **verify)
+
+    def _backup(self, session):
+        address, size = self._config.backup_region or (0, None)
+        session.read_flash(self._config.backup_path, address, size)
+        print("\nFlash contents saved to %s" % self._config.backup_path)
+
+    def _report_progress(self, event):
+        self._parent.report_progress(self._config.port, event)
+
+    def _report_timings(self, session):
+        durations = dict(session.timer.durations)
+        record = {
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'port': session.port,
+            'adapter': adapter_id(session.port) if session.port is not None else None,
+            'chip': session.chip,
+            'baud': session.baud,
+            'firmware': ["0x%x %s" % image for image in self._config.flash_images()],
+            'backup': self._config.backup_path,
+            'delta': self._config.delta,
+            'verify': self._config.verify,
+            'erase': self._config.erase_before_flash,
+            'erase_written': self._config.erase_written,
+            'erase_regions': self._config.erase_regions,
+            'succeeded': self.succeeded,
+            'phases': durations,
+            'total': session.timer.total(),
+        }
+        try:
+            record_timings(get_timings_file_path(), record)
+        except OSError as e:
+            print("Could not record timings: %s" % e)
+        self._parent.report_timings(self._config.port, session.timer.durations)
+
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# DTO between GUI and flashing thread
+class FlashConfig:
+    def __init__(self):
+        self.baud = 115200
+        self.erase_before_flash = False
+        # erase only the sectors the images are written to, padding included, rather than the whole chip
+        self.erase_written = False
+        # partition names (e.g. nvs, spiffs) or ADDRESS:SIZE to erase in addition, see PartitionTable.parse_region()
+        self.erase_regions = []
+        # write only the sectors whose contents differ from the image
+        self.delta = False
+        self.mode = "dio"
+        self.firmware_path = None
+        # (address, path) of every image to write in one session, replaces firmware_path at 0x00000 if set
+        self.images = []
+        # read the flash to this file instead of writing, the region is (address, size) or None for all of it
+        self.backup_path = None
+        self.backup_region = None
+        # check every written image against the device's MD5 of its flash region
+        self.verify = True
+        # MD5 of the image files by path, filled in by check_firmware(), not persisted
+        self.digests = {}
+        # image header settings and target chip from a build manifest, not persisted
+        self.flash_size = None
+        self.flash_freq = "keep"
+        self.chip = None
+        self.port = None
+        # fastest stable baud rate found for each USB-serial adapter
+        self.adapter_bauds = {}
+        # explicit selection if port is __multiple_ports__
+        self.ports = []
+        # run jobs in worker processes (see WorkerPool) rather than threads of this process
+        self.use_processes = False
+
+    @classmethod
+    def load(cls, file_path):
+        conf = cls()
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as f:
+                data = json.load(f)
+            conf.port = data['port']
+            conf.baud = data['baud']
+            conf.mode = data['mode']
+            conf.erase_before_flash = data['erase']
+            conf.erase_written = data.get('erase_written', False)
+            conf.erase_regions = data.get('erase_regions', [])
+            conf.ports = data.get('ports', [])
+            conf.delta = data.get('delta', False)
+            conf.adapter_bauds = data.get('adapter_bauds', {})
+            conf.use_processes = data.get('processes', False)
+            conf.verify = data.get('verify', True)
+        return conf
+
+    def safe(self, file_path):
+        data = {
+            'port': self.port,
+            'baud': self.baud,
+            'mode': self.mode,
+            'erase': self.erase_before_flash,
+            'erase_written': self.erase_written,
+            'erase_regions': self.erase_regions,
+            'ports': self.ports,
+            'delta': self.delta,
+            'adapter_bauds': self.adapter_bauds,
+            'processes': self.use_processes,
+            'verify': self.verify,
+        }
+        with open(file_path, 'w') as f:
+            json.dump(data, f)
+
+    def is_complete(self):
+        return len(self.flash_images()) > 0 and self.port is not None
+
+    def flash_images(self):
+        if len(self.images) > 0:
+            return list(self.images)
+        if self.firmware_path is None:
+            return []
+        return [(0x00000, self.firmware_path)]
+
+    def describe_erase(self):
+        if self.erase_before_flash:
+            return ", erasing all flash first"
+        text = ", erasing the written sectors first" if self.erase_written else ""
+        if len(self.erase_regions) > 0:
+            text += ", erasing %s" % ", ".join(self.erase_regions)
+        return text
+
+    def apply_manifest(self, manifest):
+        # takes over the images and flash settings of a BuildManifest
+        self.images = list(manifest.images)
+        self.firmware_path = None
+        if manifest.flash_mode in __flash_modes__:
+            self.mode = manifest.flash_mode
+        self.flash_size = manifest.flash_size
+        self.flash_freq = manifest.flash_freq or "keep"
+        self.chip = manifest.chip
+
+    def clear_manifest(self):
+        self.flash_size = None
+        self.flash_freq = "keep"
+        self.chip = None
+
+    def resolve_ports(self):
+        if self.port is None:
+            return []
+        if self.port.startswith(__all_espressif__):
+            return get_espressif_ports()
+        if self.port.startswith(__multiple_ports__):
+            return list(self.ports)
+        return [self.port]
+
+    def for_port(self, port):
+        # every worker gets its own copy so that concurrent jobs don't share state
+        conf = copy.copy(self)
+        conf.port = port
+        conf.ports = []
+        if self.backup_path is not None:
+            conf.backup_path = backup_path_for(self.backup_path, port)
+        return conf
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Pre-flight check of the firmware files before any serial I/O. Returns (address, path, image info) for every image
+# and a list of warnings, raises InvalidImageError if the files can't be flashed. In jobs with several images, files
+# that aren't ESP images at all (partition tables, file systems) are written as data and have no image info. With a
+# FirmwareCatalog unchanged files aren't parsed again and their MD5s are kept in config.digests for verification.
+def check_firmware(config, catalog=None):
+    images = config.flash_images()
+    if len(images) == 0:
+        raise InvalidImageError("No firmware file chosen.")
+    checked = []
+    warnings = []
+    regions = []
+    digests = {}
+    for address, path in images:
+        try:
+            info, digest = _inspect_firmware(path, catalog)
+            size = info.length if info is not None else firmware_stat(path)[0]
+        except OSError as e:
+            raise InvalidImageError("Could not read %s: %s" % (path, e.strerror))
+        if info is None and len(images) == 1:
+            raise NotAnImageError("%s is not an ESP firmware image." % path)
+        if info is not None:
+            warnings.extend(check_image(info, config.mode, config.chip))
+        checked.append((address, path, info))
+        regions.append((address, size, os.path.basename(path)))
+        if digest is not None:
+            digests[path] = digest
+    check_layout(regions)
+    chips = sorted(set(info.chip for address, path, info in checked if info is not None))
+    if len(chips) > 1:
+        raise InvalidImageError("The images are for different chips: %s." % ", ".join(chips))
+    config.digests = digests
+    return checked, warnings
+
+
+def describe_firmware(checked):
+    return ["0x%05x %s: %s" % (address, os.path.basename(path), describe_image(info) if info is not None else "data")
+            for address, path, info in checked]
+
+
+def _inspect_firmware(path, catalog):
+    # (image info, MD5 of the file), the MD5 is only known from the catalog
+    if catalog is not None:
+        entry = catalog.lookup(path)
+        if entry.error is not None:
+            raise InvalidImageError(entry.error)
+        return entry.image, entry.md5
+    try:
+        return inspect_image(path), None
+    except NotAnImageError:
+        return None, None
+
+
+# A port can only be used by one job at a time, returns False if another job has it
+def claim_port(port):
+    with _busy_ports_lock:
+        if port in _busy_ports:
+            return False
+        _busy_ports.add(port)
+        return True
+
+
+def release_port(port):
+    with _busy_ports_lock:
+        _busy_ports.discard(port)
+
+
+def is_port_busy(port):
+    with _busy_ports_lock:
+        return port in _busy_ports
+
+
+# Backups of several ports go to one file per port, "{port}" in the path is replaced by the port's name
+def backup_path_for(path, port):
+    return path.replace("{port}", re.sub(r"[^\w.-]+", "_", os.path.basename(port)))
+
+
+def backup_path_template(path, port_count):
+    if port_count < 2 or "{port}" in path:
+        return path
+    root, extension = os.path.splitext(path)
+    return "%s-{port}%s" % (root, extension)
+
+
+# Parses "0x1000" or "4096"
+def parse_address(value):
+    return int(value, 0)
+
+
+def get_espressif_ports():
+    # pyserial sorts ports in natural order, "ttyUSB2" before "ttyUSB10"
+    return [port.device for port in sorted(list_ports.comports()) if port.vid in __espressif_usb_vids__]
+
+
+# Same directory wx.StandardPaths.GetUserConfigDir() returns, so GUI and headless mode share config and cache.
+def get_user_config_dir():
+    if sys.platform == "win32":
+        return os.environ.get("APPDATA", os.path.expanduser("~"))
+    if sys.platform == "darwin":
+        return os.path.expanduser("~/Library/Preferences")
+    return os.path.expanduser("~")
+
+
+def get_config_file_path():
+    return os.path.join(get_user_config_dir(), "nodemcu-pyflasher.json")
+
+
+def get_cache_dir_path():
+    return os.path.join(get_user_config_dir(), "nodemcu-pyflasher-cache")
+
+
+def get_catalog_file_path():
+    return os.path.join(get_user_config_dir(), "nodemcu-pyflasher-catalog.sqlite")
+
+
+def get_timings_file_path():
+    return os.path.join(get_user_config_dir(), "nodemcu-pyflasher-timings.jsonl")
+
+
+# Appends one JSON object per line so that timings of many sessions can be compared, e.g. across adapters or cables
+def record_timings(file_path, record):
+    with _timings_lock:
+        with open(file_path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+# ---------------------------------------------------------------------------
@@ -0,0 +1,250 @@
+# coding=utf-8
+
+import argparse
+import os
+import re
+import sys
+
+from EspSession import SessionPool, __auto_baud__
+from BuildManifest import ManifestError, __manifest_names__, is_manifest, load_manifest
+from FirmwareCache import FirmwareCache
+from OutputRouter import OutputRouter, PrefixedStream
+from Progress import format_timings
+from WorkerPool import WorkerPool
+from FirmwareCatalog import FirmwareCatalog
+from FirmwareImage import InvalidImageError
+from FirmwareSource import resolve_firmware_path
+from PartitionTable import parse_region
+from Flasher import FlashConfig, FlashingThread, backup_path_template, check_firmware, describe_firmware, \
+    parse_address, get_cache_dir_path, get_catalog_file_path, get_config_file_path, __version__, __auto_select__, \
+    __all_espressif__, __flash_modes__
+
+# ---------------------------------------------------------------------------
+
+
+# Stands in for the GUI frame as the parent of the flashing threads
+class ConsoleReporter:
+    def __init__(self, stream, prefix_output=False, log_dir=None):
+        self.statuses = {}
+        self._stream = stream
+        self._prefix_output = prefix_output
+        self._log_dir = log_dir
+        self._log_files = []
+
+    def report_status(self, port, status):
+        self.statuses[port] = status
+        if status != "Flashing":
+            self._stream.write("%s: %s\n" % (port, status))
+
+    def report_progress(self, port, event):
+        # the console output already shows progress, structured events are for the GUI
+        pass
+
+    def report_timings(self, port, durations):
+        self._stream.write("%s: %s\n" % (port, format_timings(durations)))
+
+    # noinspection PyMethodMayBeStatic
+    def report_error(self, port, message):
+        sys.stderr.write("%s: %s\n" % (port, message))
+
+    def output_sink(self, port):
+        if self._log_dir is not None:
+            log_file = open(os.path.join(self._log_dir, re.sub(r"[^\w.-]", "_", port) + ".log"), "w")
+            self._log_files.append(log_file)
+            return PrefixedStream(log_file, "")
+        if self._prefix_output:
+            return PrefixedStream(self._stream, "[%s] " % port)
+        return self._stream
+
+    def close(self):
+        for log_file in self._log_files:
+            log_file.close()
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+def parse_baud(value):
+    if value == "auto":
+        return __auto_baud__
+    return int(value)
+
+
+def parse_backup_region(value):
+    region = parse_region(value)
+    if not isinstance(region, tuple):
+        raise ValueError("not ADDRESS:SIZE")
+    return region
+
+
+def check_region(value):
+    # validated here, passed on as given
+    parse_region(value)
+    return value
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="nodemcu-pyflasher --headless",
+                                     description="NodeMCU PyFlasher %s, headless mode" % __version__)
+    parser.add_argument("firmware", nargs="?",
+                        help="firmware image to flash at 0x00000, may be a member of a zip or tar(.gz) bundle, e.g. "
+                             "build.zip/nodemcu.bin; an ESP-IDF flasher_args.json or flash_project_args (or a bundle "
+                             "containing one) flashes all images it lists with its flash settings")
+    parser.add_argument("--image", "-i", nargs=2, action="append", metavar=("ADDRESS", "FILE"),
+                        help="image to flash at an address, e.g. 0x1000 bootloader.bin; may be repeated, all images "
+                             "are written in one session")
+    parser.add_argument("--port", "-p", action="append",
+                        help="serial port, may be repeated to flash several ports in parallel; 'auto' (default) "
+                             "picks the first port with an Espressif device, 'all' flashes every one of them")
+    parser.add_argument("--baud", "-b", type=parse_baud, default=115200,
+                        help="baud rate or 'auto' for the fastest stable rate (default: 115200)")
+    parser.add_argument("--mode", "-m", choices=__flash_modes__,
+                        help="flash mode (default: the build manifest's or dio)")
+    erase = parser.add_mutually_exclusive_group()
+    erase.add_argument("--erase", action="store_true", help="erase all flash before writing, wipes all data")
+    erase.add_argument("--erase-written", action="store_true",
+                       help="erase only the sectors the images are written to, skips writing their 0xFF padding")
+    parser.add_argument("--erase-region", action="append", type=check_region, metavar="PARTITION|ADDRESS:SIZE",
+                        help="also erase a partition, e.g. nvs or spiffs, or a region like 0x3fc000:0x4000; may be "
+                             "repeated")
+    parser.add_argument("--backup", metavar="FILE",
+                        help="read the flash to a file instead of writing, at the fastest stable baud rate; with "
+                             "several ports {port} in the name is replaced by the port")
+    parser.add_argument("--backup-region", type=parse_backup_region, metavar="ADDRESS:SIZE",
+                        help="part of the flash to back up (default: all of it)")
+    parser.add_argument("--delta", action="store_true", help="write only the sectors whose contents changed")
+    parser.add_argument("--no-verify", dest="verify", action="store_false",
+                        help="don't check the written images against the device's MD5 of the flash")
+    parser.add_argument("--processes", action="store_true",
+                        help="run every job in a worker process instead of a thread, uses more cores")
+    parser.add_argument("--log-dir", help="write the output of every port to its own file in this directory")
+    parser.add_argument("--version", action="version", version="%(prog)s " + __version__)
+    return parser
+
+
+def resolve_ports(requested):
+    ports = []
+    for port in requested or ["auto"]:
+        if port == "auto":
+            ports.append(__auto_select__)
+        elif port == "all":
+            config = FlashConfig()
+            config.port = __all_espressif__
+            ports.extend(config.resolve_ports())
+        else:
+            ports.append(port)
+    return ports
+
+
+def check_firmware_files(config):
+    catalog = FirmwareCatalog(get_catalog_file_path())
+    try:
+        checked, warnings = check_firmware(config, catalog)
+        for address, path in config.flash_images():
+            catalog.mark_used(path)
+    except InvalidImageError as e:
+        sys.stderr.write("Firmware check failed: %s\n" % e)
+        return False
+    finally:
+        catalog.close()
+    for line in describe_firmware(checked):
+        print("Firmware: %s" % line)
+    for warning in warnings:
+        sys.stderr.write("Warning: %s\n" % warning)
+    return True
+
+
+def main(argv):
+    args = build_parser().parse_args(argv)
+
+    # only the adapter baud rates are taken from (and written back to) the GUI's configuration
+    stored_config = FlashConfig.load(get_config_file_path())
+    config = FlashConfig()
+    try:
+        images = []
+        firmware = resolve_firmware_path(args.firmware, __manifest_names__) if args.firmware is not None else None
+        if firmware is not None and is_manifest(firmware):
+            config.apply_manifest(load_manifest(firmware))
+            print("Build manifest: %s" % firmware)
+            images += config.images
+        elif firmware is not None:
+            images.append((0x00000, firmware))
+        images += [(parse_address(address), resolve_firmware_path(path)) for address, path in args.image or []]
+    except ValueError as e:
+        sys.stderr.write("Invalid address: %s\n" % e)
+        return 2
+    except OSError as e:
+        sys.stderr.write("%s\n" % e.strerror)
+        return 2
+    except ManifestError as e:
+        sys.stderr.write("%s\n" % e)
+        return 2
+    if len(images) == 1 and images[0][0] == 0x00000:
+        config.firmware_path = images[0][1]
+        config.images = []
+    else:
+        config.images = images
+    config.baud = args.baud
+    if args.mode is not None:
+        config.mode = args.mode
+    config.erase_before_flash = args.erase
+    config.erase_written = args.erase_written
+    config.erase_regions = args.erase_region or []
+    config.delta = args.delta
+    config.verify = args.verify
+    config.use_processes = args.processes
+    config.adapter_bauds = stored_config.adapter_bauds
+
+    if args.backup is not None:
+        if len(config.flash_images()) > 0:
+            sys.stderr.write("A backup doesn't write any firmware, leave out the images\n")
+            return 2
+    elif not check_firmware_files(config):
+        return 2
+
+    ports = resolve_ports(args.port)
+    if len(ports) == 0:
+        sys.stderr.write("No matching serial port found\n")
+        return 2
+    if args.backup is not None:
+        config.backup_path = backup_path_template(args.backup, len(ports))
+        config.backup_region = args.backup_region
+
+    stdout = sys.stdout
+    reporter = ConsoleReporter(stdout, prefix_output=len(ports) > 1, log_dir=args.log_dir)
+    session_pool = SessionPool(FirmwareCache(get_cache_dir_path()), config.adapter_bauds)
+    worker_pool = None
+    if config.use_processes:
+        worker_pool = WorkerPool(reporter, get_cache_dir_path(), config.adapter_bauds, max_workers=len(ports))
+        workers = [worker_pool.create_job(config.for_port(port)) for port in ports]
+    else:
+        workers = [FlashingThread(reporter, config.for_port(port), session_pool, raise_errors=False) for port in ports]
+    sys.stdout = OutputRouter(stdout)
+    try:
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            # Ctrl+C cancels the jobs, they release their ports at the next block boundary
+            stdout.write("Cancelling...\n")
+            for worker in workers:
+                worker.cancel()
+            for worker in workers:
+                worker.join()
+    finally:
+        session_pool.close_all()
+        if worker_pool is not None:
+            worker_pool.close()
+        sys.stdout = stdout
+        reporter.close()
+        stored_config.safe(get_config_file_path())
+
+    return 0 if all(worker.succeeded for worker in workers) else 1
+
+# ---------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -4,21 +4,39 @@ import wx
 import wx.adv
 import wx.lib.inspection
 import wx.lib.mixins.inspection
+import wx.lib.newevent
 
-import sys
+import bisect
+import copy
+import functools
 import os
-import esptool
+import sys
 import threading
-import json
+import time
 import images as images
-from serial import SerialException
+from ConsoleBuffer import ConsoleBuffer
+from EspSession import SessionPool, __auto_baud__
+from BuildManifest import ManifestError, __manifest_names__, is_manifest, load_manifest
+from FirmwareCache import FirmwareCache
+from OutputRouter import OutputRouter
+from PortWatcher import PortWatcher
+from Progress import format_progress, format_timings
+from UpdateChannel import PostingStream, UpdateChannel
+from WorkerPool import WorkerPool
+from FirmwareCatalog import FirmwareCatalog, describe_entry
+from FirmwareImage import InvalidImageError
+from PartitionTable import parse_region
+from FirmwareSource import is_archive, join_archive_path, list_members, resolve_firmware_path
+from Flasher import FlashConfig, FlashingThread, backup_path_template, check_firmware, describe_firmware, \
+    is_port_busy, parse_address, get_cache_dir_path, get_catalog_file_path, get_config_file_path, __version__, \
+    __auto_select__, __all_espressif__, __espressif_usb_vids__, __multiple_ports__, __supported_baud_rates__
 from serial.tools import list_ports
+from serial.tools.list_ports_common import numsplit
 import locale
 
 # see https://discuss.wxpython.org/t/wxpython4-1-1-python3-8-locale-wxassertionerror/35168
 locale.setlocale(locale.LC_ALL, 'C')
 
-__version__ = "5.1.0"
 __flash_help__ = '''
 <p>This setting is highly dependent on your device!<p>
 <p>
@@ -33,119 +51,75 @@ __flash_help__ = '''
 </ul>
 </p>
 '''
-__auto_select__ = "Auto-select"
+__console_refresh_rate__ = 10
+# how often updates posted by the flashing threads are handed to the UI, in ms
+__update_interval__ = 50
 __auto_select_explanation__ = "(first port with Espressif device)"
-__supported_baud_rates__ = [9600, 57600, 74880, 115200, 230400, 460800, 921600]
+__all_espressif_explanation__ = "(flash every matching port in parallel)"
+# posted to the frame when the port watcher sees a serial port come or go, carry port (the device name) and info
+# (pyserial's ListPortInfo)
+DeviceAttachedEvent, EVT_DEVICE_ATTACHED = wx.lib.newevent.NewEvent()
+DeviceDetachedEvent, EVT_DEVICE_DETACHED = wx.lib.newevent.NewEvent()
+# station mode waits this long (ms) after a device is attached before opening its port, the OS may still set it up
+__station_settle_delay__ = 500
+# boards with native USB (Espressif's own VID) re-enumerate when they are reset after flashing, the same device coming
+# back on its port this many seconds after its job is not flashed again. Its serial number is the chip's MAC.
+__native_usb_vid__ = 0x303A
+__station_reattach_grace__ = 10
+# one worker process per port being flashed, they are only started as jobs need them. 61 is the most
+# ProcessPoolExecutor allows on Windows.
+__max_worker_processes__ = 61
+__pass_colour__ = wx.Colour(200, 240, 200)
+__fail_colour__ = wx.Colour(250, 200, 200)
 
 # ---------------------------------------------------------------------------
 
 
 # See discussion at http://stackoverflow.com/q/41101897/131929
+# Output is collected in bounded ConsoleBuffers, one per source (each flashing job writes to its own, the main thread
+# to the None source). The text control shows one of them and catches up with it at most __console_refresh_rate__
+# times per second, and only with what changed since the last refresh.
 class RedirectText:
     def __init__(self, text_ctrl):
         self.__out = text_ctrl
-
-    def write(self, string):
-        if string.startswith("\r"):
-            # carriage return -> remove last line i.e. reset position to start of last line
-            current_value = self.__out.GetValue()
-            last_newline = current_value.rfind("\n")
-            new_value = current_value[:last_newline + 1]  # preserve \n
-            new_value += string[1:]  # chop off leading \r
-            wx.CallAfter(self.__out.SetValue, new_value)
-        else:
-            wx.CallAfter(self.__out.AppendText, string)
-
-    # noinspection PyMethodMayBeStatic
-    def flush(self):
-        # noinspection PyStatementEffect
-        None
-
-    # esptool >=3 handles output differently of the output stream is not a TTY
-    # noinspection PyMethodMayBeStatic
-    def isatty(self):
-        return True
-
-# ---------------------------------------------------------------------------
-
-
-# ---------------------------------------------------------------------------
-class FlashingThread(threading.Thread):
-    def __init__(self, parent, config):
-        threading.Thread.__init__(self)
-        self.daemon = True
-        self._parent = parent
-        self._config = config
-
-    def run(self):
-        try:
-            command = []
-
-            if not self._config.port.startswith(__auto_select__):
-                command.append("--port")
-                command.append(self._config.port)
-
-            command.extend(["--baud", str(self._config.baud),
-                            "--after", "no_reset",
-                            "write_flash",
-                            # https://github.com/espressif/esptool/issues/599
-                            "--flash_size", "detect",
-                            "--flash_mode", self._config.mode,
-                            "0x00000", self._config.firmware_path])
-
-            if self._config.erase_before_flash:
-                command.append("--erase-all")
-
-            print("Command: esptool.py %s\n" % " ".join(command))
-
-            esptool.main(command)
-
-            # The last line printed by esptool is "Staying in bootloader." -> some indication that the process is
-            # done is needed
-            print("\nFirmware successfully flashed. Unplug/replug or reset device \nto switch back to normal boot "
-                  "mode.")
-        except SerialException as e:
-            self._parent.report_error(e.strerror)
-            raise e
-
-
-# ---------------------------------------------------------------------------
-
-
-# ---------------------------------------------------------------------------
-# DTO between GUI and flashing thread
-class FlashConfig:
-    def __init__(self):
-        self.baud = 115200
-        self.erase_before_flash = False
-        self.mode = "dio"
-        self.firmware_path = None
-        self.port = None
-
-    @classmethod
-    def load(cls, file_path):
-        conf = cls()
-        if os.path.exists(file_path):
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-            conf.port = data['port']
-            conf.baud = data['baud']
-            conf.mode = data['mode']
-            conf.erase_before_flash = data['erase']
-        return conf
-
-    def safe(self, file_path):
-        data = {
-            'port': self.port,
-            'baud': self.baud,
-            'mode': self.mode,
-            'erase': self.erase_before_flash,
-        }
-        with open(file_path, 'w') as f:
-            json.dump(data, f)
-
-    def is_complete(self):
-        return self.firmware_path is not None and self.port is not None
+        self.__buffers = {None: ConsoleBuffer()}
+        self.__shown = None
+        self.__timer = wx.Timer(text_ctrl)
+        text_ctrl.Bind(wx.EVT_TIMER, self._refresh, self.__timer)
+        self.__timer.Start(1000 // __console_refresh_rate__)
+
+    def write(self, string, source=None):
+        self._buffer(source).write(string)
+
+    def reset(self):
+        # drops the output of all jobs
+        self.__buffers = {None: ConsoleBuffer()}
+        self.show(None)
+
+    def show(self, source):
+        self.__shown = source
+        self._buffer(source).invalidate()
+
+    def _buffer(self, source):
+        if source not in self.__buffers:
+            self.__buffers[source] = ConsoleBuffer()
+        return self.__buffers[source]
+
+    def _refresh(self, event):
+        changes = self._buffer(self.__shown).take_changes()
+        if changes is None:
+            return
+        if changes.reset:
+            self.__out.SetValue(changes.text)
+            return
+        if changes.removed_chars > 0:
+            # carriage return -> the last line was rewritten
+            end = self.__out.GetLastPosition()
+            self.__out.Remove(end - changes.removed_chars, end)
+        if changes.removed_lines > 0:
+            self.__out.Remove(0, self.__out.XYToPosition(0, changes.removed_lines))
+        if len(changes.text) > 0:
+            self.__out.AppendText(changes.text)
 
 # ---------------------------------------------------------------------------
 
@@ -157,13 +131,47 @@ class NodeMcuFlasher(wx.Frame):
         wx.Frame.__init__(self, parent, -1, title, size=(725, 650),
                           style=wx.DEFAULT_FRAME_STYLE | wx.NO_FULL_REPAINT_ON_RESIZE)
         self._config = FlashConfig.load(self._get_config_file_path())
+        # port whose console and progress are shown
+        self._selected_job = None
+        self._session_pool = SessionPool(FirmwareCache(self._get_cache_dir_path()), self._config.adapter_bauds)
+        # started when the first job is run in worker processes
+        self._worker_pool = None
+        # jobs started by the last click, see _start_jobs()
+        self._jobs = []
+        # settings every attached device is flashed with while station mode is on, see _on_device_attached()
+        self._station_config = None
+        # port -> running job, port -> (hwid, time finished) of its last job and the number of passed and failed devices
+        self._station_jobs = {}
+        self._station_flashed = {}
+        self._station_counts = [0, 0]
+        self._catalog = FirmwareCatalog(get_catalog_file_path())
 
         self._build_status_bar()
         self._set_icons()
         self._build_menu_bar()
         self._init_ui()
 
-        sys.stdout = RedirectText(self.console_ctrl)
+        self._console = RedirectText(self.console_ctrl)
+        self._updates = UpdateChannel()
+        self._update_handlers = {
+            "console": lambda payload: self._console.write(payload[1], payload[0]),
+            "status": lambda payload: self._update_result(*payload),
+            "progress": lambda payload: self._update_progress(*payload),
+            "error": lambda payload: self._show_error(*payload),
+            "timings": lambda payload: self._show_timings(*payload),
+            "ports": lambda payload: self._update_ports(*payload),
+        }
+        self._update_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self._on_update_timer, self._update_timer)
+        self._update_timer.Start(__update_interval__)
+        # output of the flashing threads is routed to their own consoles, see output_sink()
+        sys.stdout = OutputRouter(PostingStream(functools.partial(self._post_console, None)))
+        # keeps the port list up to date as boards are plugged in and out, replaces reloading it by hand
+        self._port_watcher = PortWatcher(lambda attached, detached: self._updates.post("ports", (attached, detached)))
+        self._port_watcher.start()
+        self.Bind(EVT_DEVICE_ATTACHED, self._on_device_attached)
+        self.Bind(EVT_DEVICE_DETACHED, lambda event: self._session_pool.close(event.port))
+        self.Bind(wx.EVT_CLOSE, self._on_close_window)
 
         self.Centre(wx.BOTH)
         self.Show(True)
@@ -172,9 +180,6 @@ class NodeMcuFlasher(wx.Frame):
         print("turn off Bluetooth")
 
     def _init_ui(self):
-        def on_reload(event):
-            self.choice.SetItems(self._get_serial_ports())
-
         def on_baud_changed(event):
             radio_button = event.GetEventObject()
 
@@ -192,18 +197,127 @@ class NodeMcuFlasher(wx.Frame):
 
             if radio_button.GetValue():
                 self._config.erase_before_flash = radio_button.erase
+                self._config.erase_written = radio_button.erase_written
+
+        def on_erase_regions(event):
+            self._edit_erase_regions()
+
+        def on_write_mode_changed(event):
+            radio_button = event.GetEventObject()
+
+            if radio_button.GetValue():
+                self._config.delta = radio_button.delta
+
+        def on_verify_changed(event):
+            radio_button = event.GetEventObject()
+
+            if radio_button.GetValue():
+                self._config.verify = radio_button.verify
+
+        def on_run_mode_changed(event):
+            radio_button = event.GetEventObject()
+
+            if radio_button.GetValue():
+                self._config.use_processes = radio_button.use_processes
 
         def on_clicked(event):
-            self.console_ctrl.SetValue("")
-            worker = FlashingThread(self, self._config)
-            worker.start()
+            if self._jobs_running():
+                return
+            self._console.reset()
+            self.results_ctrl.DeleteAllItems()
+            self.gauge.SetValue(0)
+            if not self._check_firmware():
+                return
+            ports = self._config.resolve_ports()
+            if len(ports) == 0:
+                print("No matching serial port found")
+                return
+            for address, path in self._config.flash_images():
+                self._catalog.mark_used(path)
+            self._start_jobs(self._config, ports)
+
+        def on_backup(event):
+            if self._jobs_running():
+                return
+            self._console.reset()
+            self.results_ctrl.DeleteAllItems()
+            self.gauge.SetValue(0)
+            ports = self._config.resolve_ports()
+            if len(ports) == 0:
+                print("No matching serial port found")
+                return
+            dialog = wx.FileDialog(self, "Save flash contents to", defaultFile="backup.bin",
+                                   wildcard="Flash images (*.bin)|*.bin", style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+            if dialog.ShowModal() == wx.ID_OK:
+                config = copy.copy(self._config)
+                config.backup_path = backup_path_template(dialog.GetPath(), len(ports))
+                self._start_jobs(config, ports)
+            dialog.Destroy()
+
+        def on_cancel(event):
+            running = [job for job in self._jobs if job.is_alive()]
+            for job in running:
+                job.cancel()
+            if len(running) > 0:
+                print("Cancelling %d job(s), they stop at the next block written or read" % len(running))
+
+        def on_station(event):
+            if self.station_button.GetValue():
+                if self._jobs_running() or not self._check_firmware():
+                    self.station_button.SetValue(False)
+                    return
+                self._start_station()
+            else:
+                self._stop_station()
+            button.Enable(self._station_config is None)
+            backup_button.Enable(self._station_config is None)
+
+        def on_select_result(event):
+            # show the console output and progress of the selected job
+            self._selected_job = self.results_ctrl.GetItemText(event.GetIndex())
+            self._console.show(self._selected_job)
+            self.gauge.SetValue(0)
 
         def on_select_port(event):
             choice = event.GetEventObject()
-            self._config.port = choice.GetString(choice.GetSelection())
+            selection = choice.GetString(choice.GetSelection())
+            if selection.startswith(__multiple_ports__):
+                self._choose_multiple_ports()
+                self._config.port = __multiple_ports__
+            else:
+                self._config.port = selection
 
         def on_pick_file(event):
-            self._config.firmware_path = event.GetPath().replace("'", "")
+            path = event.GetPath().replace("'", "")
+            if is_archive(path):
+                path = self._choose_archive_member(path)
+                if path is None:
+                    return
+            if is_manifest(path):
+                self._apply_manifest(path)
+                return
+            self._config.firmware_path = path
+            self._config.images = []
+            self._config.clear_manifest()
+            self._check_firmware()
+
+        def on_images(event):
+            self._edit_images()
+
+        def on_recent(event):
+            entries = self._catalog.recent()
+            if len(entries) == 0:
+                print("No firmware flashed yet")
+                return
+            dialog = wx.SingleChoiceDialog(self, "Firmware", "Recently flashed",
+                                           [describe_entry(entry) for entry in entries])
+            if dialog.ShowModal() == wx.ID_OK:
+                self._config.firmware_path = entries[dialog.GetSelection()].path
+                self._config.images = []
+                self._config.clear_manifest()
+                self.file_picker.SetPath(self._config.firmware_path)
+                self._check_firmware()
+            dialog.Destroy()
 
         panel = wx.Panel(self)
 
@@ -218,28 +332,41 @@ class NodeMcuFlasher(wx.Frame):
 
         hbox = wx.BoxSizer(wx.HORIZONTAL)
 
-        fgs = wx.FlexGridSizer(7, 2, 10, 10)
+        fgs = wx.FlexGridSizer(12, 2, 10, 10)
 
         self.choice = wx.Choice(panel, choices=self._get_serial_ports())
         self.choice.Bind(wx.EVT_CHOICE, on_select_port)
         self._select_configured_port()
 
-        reload_button = wx.Button(panel, label="Reload")
-        reload_button.Bind(wx.EVT_BUTTON, on_reload)
-        reload_button.SetToolTip("Reload serial device list")
+        self.file_picker = wx.FilePickerCtrl(panel, style=wx.FLP_USE_TEXTCTRL)
+        self.file_picker.Bind(wx.EVT_FILEPICKER_CHANGED, on_pick_file)
+
+        recent_button = wx.Button(panel, label="Recent")
+        recent_button.Bind(wx.EVT_BUTTON, on_recent)
+        recent_button.SetToolTip("Pick one of the recently flashed firmware images")
+
+        images_button = wx.Button(panel, label="Images...")
+        images_button.Bind(wx.EVT_BUTTON, on_images)
+        images_button.SetToolTip("Flash several images at different addresses in one go, e.g. bootloader, "
+                                 "partition table and app")
 
-        file_picker = wx.FilePickerCtrl(panel, style=wx.FLP_USE_TEXTCTRL)
-        file_picker.Bind(wx.EVT_FILEPICKER_CHANGED, on_pick_file)
+        file_boxsizer = wx.BoxSizer(wx.HORIZONTAL)
+        file_boxsizer.Add(self.file_picker, 1, wx.EXPAND)
+        file_boxsizer.Add(recent_button, flag=wx.LEFT, border=10)
+        file_boxsizer.Add(images_button, flag=wx.LEFT, border=10)
 
         serial_boxsizer = wx.BoxSizer(wx.HORIZONTAL)
         serial_boxsizer.Add(self.choice, 1, wx.EXPAND)
-        serial_boxsizer.Add(reload_button, flag=wx.LEFT, border=10)
 
         baud_boxsizer = wx.BoxSizer(wx.HORIZONTAL)
 
         def add_baud_radio_button(sizer, index, baud_rate):
             style = wx.RB_GROUP if index == 0 else 0
-            radio_button = wx.RadioButton(panel, name="baud-%d" % baud_rate, label="%d" % baud_rate, style=style)
+            if baud_rate == __auto_baud__:
+                radio_button = wx.RadioButton(panel, name="baud-auto", label="Auto", style=style)
+                radio_button.SetToolTip("Fastest stable rate, remembered for each USB-serial adapter")
+            else:
+                radio_button = wx.RadioButton(panel, name="baud-%d" % baud_rate, label="%d" % baud_rate, style=style)
             radio_button.rate = baud_rate
             # sets default value
             radio_button.SetValue(baud_rate == self._config.baud)
@@ -247,7 +374,7 @@ class NodeMcuFlasher(wx.Frame):
             sizer.Add(radio_button)
             sizer.AddSpacer(10)
 
-        for idx, rate in enumerate(__supported_baud_rates__):
+        for idx, rate in enumerate(__supported_baud_rates__ + [__auto_baud__]):
             add_baud_radio_button(baud_boxsizer, idx, rate)
 
         flashmode_boxsizer = wx.BoxSizer(wx.HORIZONTAL)
@@ -267,21 +394,93 @@ class NodeMcuFlasher(wx.Frame):
 
         erase_boxsizer = wx.BoxSizer(wx.HORIZONTAL)
 
-        def add_erase_radio_button(sizer, index, erase_before_flash, label, value):
+        def add_erase_radio_button(sizer, index, erase_before_flash, erase_written, label, value):
             style = wx.RB_GROUP if index == 0 else 0
-            radio_button = wx.RadioButton(panel, name="erase-%s" % erase_before_flash, label="%s" % label, style=style)
+            radio_button = wx.RadioButton(panel, name="erase-%s-%s" % (erase_before_flash, erase_written),
+                                          label="%s" % label, style=style)
             radio_button.Bind(wx.EVT_RADIOBUTTON, on_erase_changed)
             radio_button.erase = erase_before_flash
+            radio_button.erase_written = erase_written
             radio_button.SetValue(value)
             sizer.Add(radio_button)
             sizer.AddSpacer(10)
 
         erase = self._config.erase_before_flash
-        add_erase_radio_button(erase_boxsizer, 0, False, "no", erase is False)
-        add_erase_radio_button(erase_boxsizer, 1, True, "yes, wipes all data", erase is True)
+        written = self._config.erase_written and not erase
+        add_erase_radio_button(erase_boxsizer, 0, False, False, "no", not erase and not written)
+        add_erase_radio_button(erase_boxsizer, 1, False, True, "written sectors", written)
+        add_erase_radio_button(erase_boxsizer, 2, True, False, "yes, wipes all data", erase)
+        erase_regions_button = wx.Button(panel, label="Regions...")
+        erase_regions_button.Bind(wx.EVT_BUTTON, on_erase_regions)
+        erase_regions_button.SetToolTip("Partitions (e.g. nvs, spiffs) or ADDRESS:SIZE regions to erase as well")
+        erase_boxsizer.Add(erase_regions_button)
+
+        write_mode_boxsizer = wx.BoxSizer(wx.HORIZONTAL)
+
+        def add_write_mode_radio_button(sizer, index, delta, label):
+            style = wx.RB_GROUP if index == 0 else 0
+            radio_button = wx.RadioButton(panel, name="delta-%s" % delta, label="%s" % label, style=style)
+            radio_button.Bind(wx.EVT_RADIOBUTTON, on_write_mode_changed)
+            radio_button.delta = delta
+            radio_button.SetValue(delta == self._config.delta)
+            sizer.Add(radio_button)
+            sizer.AddSpacer(10)
+
+        add_write_mode_radio_button(write_mode_boxsizer, 0, False, "whole image")
+        add_write_mode_radio_button(write_mode_boxsizer, 1, True, "changed sectors only")
+
+        verify_boxsizer = wx.BoxSizer(wx.HORIZONTAL)
+
+        def add_verify_radio_button(sizer, index, verify, label):
+            style = wx.RB_GROUP if index == 0 else 0
+            radio_button = wx.RadioButton(panel, name="verify-%s" % verify, label="%s" % label, style=style)
+            radio_button.Bind(wx.EVT_RADIOBUTTON, on_verify_changed)
+            radio_button.verify = verify
+            radio_button.SetValue(verify == self._config.verify)
+            sizer.Add(radio_button)
+            sizer.AddSpacer(10)
+
+        add_verify_radio_button(verify_boxsizer, 0, True, "yes, by device-side hash")
+        add_verify_radio_button(verify_boxsizer, 1, False, "no")
+
+        run_mode_boxsizer = wx.BoxSizer(wx.HORIZONTAL)
+
+        def add_run_mode_radio_button(sizer, index, use_processes, label):
+            style = wx.RB_GROUP if index == 0 else 0
+            radio_button = wx.RadioButton(panel, name="processes-%s" % use_processes, label="%s" % label, style=style)
+            radio_button.Bind(wx.EVT_RADIOBUTTON, on_run_mode_changed)
+            radio_button.use_processes = use_processes
+            radio_button.SetValue(use_processes == self._config.use_processes)
+            sizer.Add(radio_button)
+            sizer.AddSpacer(10)
+
+        add_run_mode_radio_button(run_mode_boxsizer, 0, False, "threads")
+        add_run_mode_radio_button(run_mode_boxsizer, 1, True, "worker processes (many devices)")
 
         button = wx.Button(panel, -1, "Flash NodeMCU")
         button.Bind(wx.EVT_BUTTON, on_clicked)
+        backup_button = wx.Button(panel, -1, "Backup...")
+        backup_button.Bind(wx.EVT_BUTTON, on_backup)
+        backup_button.SetToolTip("Read the whole flash of the device(s) to a file")
+        button_boxsizer = wx.BoxSizer(wx.HORIZONTAL)
+        button_boxsizer.Add(button, 1, wx.EXPAND)
+        button_boxsizer.Add(backup_button, flag=wx.LEFT, border=10)
+        cancel_button = wx.Button(panel, -1, "Cancel")
+        cancel_button.Bind(wx.EVT_BUTTON, on_cancel)
+        cancel_button.SetToolTip("Stop the running jobs and release their ports, the flash is left as far as it got")
+        button_boxsizer.Add(cancel_button, flag=wx.LEFT, border=10)
+        self.station_button = wx.ToggleButton(panel, -1, "Station mode")
+        self.station_button.Bind(wx.EVT_TOGGLEBUTTON, on_station)
+        self.station_button.SetToolTip("Flash every Espressif device as soon as it's plugged in, with these settings")
+        button_boxsizer.Add(self.station_button, flag=wx.LEFT, border=10)
+
+        self.results_ctrl = wx.ListCtrl(panel, size=(-1, 90), style=wx.LC_REPORT | wx.LC_SINGLE_SEL)
+        self.results_ctrl.InsertColumn(0, "Port", width=200)
+        self.results_ctrl.InsertColumn(1, "Status", width=200)
+        self.results_ctrl.InsertColumn(2, "Progress", width=200)
+        self.results_ctrl.Bind(wx.EVT_LIST_ITEM_SELECTED, on_select_result)
+
+        self.gauge = wx.Gauge(panel, range=1000, style=wx.GA_HORIZONTAL | wx.GA_SMOOTH)
 
         self.console_ctrl = wx.TextCtrl(panel, style=wx.TE_MULTILINE | wx.TE_READONLY | wx.HSCROLL)
         self.console_ctrl.SetFont(wx.Font((0, 13), wx.FONTFAMILY_TELETYPE, wx.FONTSTYLE_NORMAL,
@@ -319,17 +518,27 @@ class NodeMcuFlasher(wx.Frame):
         flashmode_label_boxsizer.Add(icon)
 
         erase_label = wx.StaticText(panel, label="Erase flash")
+        write_mode_label = wx.StaticText(panel, label="Write")
+        verify_label = wx.StaticText(panel, label="Verify")
+        run_mode_label = wx.StaticText(panel, label="Run jobs in")
+        results_label = wx.StaticText(panel, label="Devices")
+        progress_label = wx.StaticText(panel, label="Progress")
         console_label = wx.StaticText(panel, label="Console")
 
         fgs.AddMany([
                     port_label, (serial_boxsizer, 1, wx.EXPAND),
-                    file_label, (file_picker, 1, wx.EXPAND),
+                    file_label, (file_boxsizer, 1, wx.EXPAND),
                     baud_label, baud_boxsizer,
                     flashmode_label_boxsizer, flashmode_boxsizer,
                     erase_label, erase_boxsizer,
-                    (wx.StaticText(panel, label="")), (button, 1, wx.EXPAND),
+                    write_mode_label, write_mode_boxsizer,
+                    verify_label, verify_boxsizer,
+                    run_mode_label, run_mode_boxsizer,
+                    (wx.StaticText(panel, label="")), (button_boxsizer, 1, wx.EXPAND),
+                    results_label, (self.results_ctrl, 1, wx.EXPAND),
+                    progress_label, (self.gauge, 1, wx.EXPAND),
                     (console_label, 1, wx.EXPAND), (self.console_ctrl, 1, wx.EXPAND)])
-        fgs.AddGrowableRow(6, 1)
+        fgs.AddGrowableRow(11, 1)
         fgs.AddGrowableCol(1, 1)
         hbox.Add(fgs, proportion=2, flag=wx.ALL | wx.EXPAND, border=15)
         panel.SetSizer(hbox)
@@ -340,11 +549,31 @@ class NodeMcuFlasher(wx.Frame):
             if item == self._config.port:
                 self.choice.Select(count)
                 break
+            if item.startswith(__multiple_ports__) and self._config.port == __multiple_ports__:
+                self.choice.SetString(count, self._get_multiple_ports_label())
+                self.choice.Select(count)
+                break
             count += 1
 
+    def _choose_multiple_ports(self):
+        ports = [port for port, desc, hwid in sorted(list_ports.comports())]
+        dialog = wx.MultiChoiceDialog(self, "Select the serial ports to flash in parallel", "Multiple ports", ports)
+        dialog.SetSelections([ports.index(port) for port in self._config.ports if port in ports])
+        if dialog.ShowModal() == wx.ID_OK:
+            self._config.ports = [ports[index] for index in dialog.GetSelections()]
+        dialog.Destroy()
+        self.choice.SetString(self.choice.GetSelection(), self._get_multiple_ports_label())
+
+    def _get_multiple_ports_label(self):
+        if len(self._config.ports) == 0:
+            return __multiple_ports__
+        return "%s (%s)" % (__multiple_ports__, ", ".join(self._config.ports))
+
     @staticmethod
     def _get_serial_ports():
-        ports = [__auto_select__ + " " + __auto_select_explanation__]
+        ports = [__auto_select__ + " " + __auto_select_explanation__,
+                 __all_espressif__ + " " + __all_espressif_explanation__,
+                 __multiple_ports__]
         for port, desc, hwid in sorted(list_ports.comports()):
             ports.append(port)
         return ports
@@ -364,6 +593,9 @@ class NodeMcuFlasher(wx.Frame):
         # File menu
         file_menu = wx.Menu()
         wx.App.SetMacExitMenuItemId(wx.ID_EXIT)
+        index_item = file_menu.Append(wx.ID_ANY, "&Index firmware folder...", "Add the images in a folder to the "
+                                                                             "firmware catalog")
+        self.Bind(wx.EVT_MENU, self._on_index_folder, index_item)
         exit_item = file_menu.Append(wx.ID_EXIT, "E&xit\tCtrl-Q", "Exit NodeMCU PyFlasher")
         exit_item.SetBitmap(images.Exit.GetBitmap())
         self.Bind(wx.EVT_MENU, self._on_exit_app, exit_item)
@@ -377,26 +609,298 @@ class NodeMcuFlasher(wx.Frame):
 
         self.SetMenuBar(self.menuBar)
 
+    def _choose_archive_member(self, archive):
+        try:
+            if len(list_members(archive, __manifest_names__)) > 0:
+                # a bundle with a build manifest is flashed as a whole
+                return resolve_firmware_path(archive, __manifest_names__)
+            members = list_members(archive)
+        except OSError as e:
+            print(e.strerror)
+            return None
+        if len(members) == 0:
+            print("%s doesn't contain any .bin image" % archive)
+            return None
+        if len(members) == 1:
+            return join_archive_path(archive, members[0])
+        dialog = wx.SingleChoiceDialog(self, "Image to flash", os.path.basename(archive), members)
+        member = members[dialog.GetSelection()] if dialog.ShowModal() == wx.ID_OK else None
+        dialog.Destroy()
+        return join_archive_path(archive, member) if member is not None else None
+
+    def _edit_images(self):
+        # one "address path" line per image
+        lines = "\n".join("0x%05x %s" % image for image in self._config.flash_images())
+        dialog = wx.TextEntryDialog(self, "One image per line: address and file, e.g. 0x1000 bootloader.bin",
+                                    "Images", lines, style=wx.TextEntryDialogStyle | wx.TE_MULTILINE)
+        if dialog.ShowModal() == wx.ID_OK:
+            try:
+                images = [(parse_address(address), path.strip()) for address, path in
+                          (line.strip().split(None, 1) for line in dialog.GetValue().splitlines() if line.strip())]
+            except ValueError:
+                print("Every line needs an address and a file, e.g. 0x1000 bootloader.bin")
+                images = None
+            if images is not None:
+                self._config.images = images
+                self._config.firmware_path = None
+                self._config.clear_manifest()
+                self.file_picker.SetPath("")
+                self._check_firmware()
+        dialog.Destroy()
+
+    def _apply_manifest(self, path):
+        try:
+            manifest = load_manifest(path)
+        except (ManifestError, OSError) as e:
+            print(e.strerror if isinstance(e, OSError) else e)
+            return
+        print("Build manifest: %s" % path)
+        self._config.apply_manifest(manifest)
+        wx.FindWindowByName("mode-%s" % self._config.mode).SetValue(True)
+        self._check_firmware()
+
+    def _edit_erase_regions(self):
+        dialog = wx.TextEntryDialog(self, "Partitions or ADDRESS:SIZE regions to erase before writing, separated by "
+                                    "commas, e.g. nvs, spiffs, 0x3fc000:0x4000", "Erase regions",
+                                    ", ".join(self._config.erase_regions))
+        if dialog.ShowModal() == wx.ID_OK:
+            regions = [region.strip() for region in dialog.GetValue().split(",") if region.strip()]
+            try:
+                for region in regions:
+                    parse_region(region)
+                self._config.erase_regions = regions
+            except ValueError:
+                print("Regions are partition names or ADDRESS:SIZE, e.g. 0x3fc000:0x4000")
+        dialog.Destroy()
+
+    def _check_firmware(self):
+        try:
+            checked, warnings = check_firmware(self._config, self._catalog)
+        except InvalidImageError as e:
+            print("Firmware check failed: %s" % e)
+            self.statusBar.SetStatusText("Invalid firmware image", 0)
+            return False
+        lines = describe_firmware(checked)
+        for line in lines:
+            print("Firmware: %s" % line)
+        for warning in warnings:
+            print("Warning: %s" % warning)
+        self.statusBar.SetStatusText("Firmware: %s" % (lines[0] if len(lines) == 1 else "%d images" % len(lines)), 0)
+        return True
+
+    def _start_jobs(self, config, ports):
+        self._jobs = []
+        for port in ports:
+            self.results_ctrl.Append([port, "Waiting", ""])
+            worker = self._create_job(config.for_port(port))
+            worker.start()
+            self._jobs.append(worker)
+        self.results_ctrl.Select(0)
+
+    def _start_station(self):
+        for address, path in self._config.flash_images():
+            self._catalog.mark_used(path)
+        # later changes to the settings don't affect the station until it's restarted
+        self._station_config = copy.copy(self._config)
+        self._station_jobs = {}
+        self._station_flashed = {}
+        self._station_counts = [0, 0]
+        self._jobs = []
+        self._console.reset()
+        self.results_ctrl.DeleteAllItems()
+        self.gauge.SetValue(0)
+        print("Station mode: plug in the devices to flash, unplug them once they passed")
+        self.statusBar.SetStatusText("Station mode: waiting for devices", 0)
+
+    def _stop_station(self):
+        self._station_config = None
+        print("Station mode off: %d passed, %d failed" % tuple(self._station_counts))
+        if len(self._station_jobs) > 0:
+            print("%d job(s) still running, they aren't cancelled" % len(self._station_jobs))
+
+    def _on_device_attached(self, event):
+        if self._station_config is None or event.info.vid not in __espressif_usb_vids__:
+            return
+        if event.port in self._station_jobs:
+            return
+        hwid, finished = self._station_flashed.get(event.port, (None, None))
+        if event.info.vid == __native_usb_vid__ and hwid == event.info.hwid \
+                and time.time() - finished < __station_reattach_grace__:
+            return
+        wx.CallLater(__station_settle_delay__, self._start_station_job, event.port, event.info.hwid)
+
+    def _start_station_job(self, port, hwid):
+        if self._station_config is None or port in self._station_jobs or is_port_busy(port):
+            return
+        index = self.results_ctrl.FindItem(-1, port)
+        if index == wx.NOT_FOUND:
+            index = self.results_ctrl.Append([port, "Waiting", ""])
+        self.results_ctrl.SetItem(index, 1, "Waiting")
+        self.results_ctrl.SetItem(index, 2, "")
+        self.results_ctrl.SetItemBackgroundColour(index, self.results_ctrl.GetBackgroundColour())
+        self.results_ctrl.Select(index)
+        worker = self._create_job(self._station_config.for_port(port))
+        worker.start()
+        self._station_jobs[port] = worker
+        # a device re-enumerating while it's flashed must not start a second job once this one is finished
+        self._station_flashed[port] = (hwid, None)
+        self._jobs = list(self._station_jobs.values())
+
+    def _update_station(self, finished):
+        # marks the slots of finished jobs as passed or failed, their last status has been drained already
+        for port in finished:
+            job = self._station_jobs.pop(port)
+            self._station_flashed[port] = (self._station_flashed[port][0], time.time())
+            self._station_counts[0 if job.succeeded else 1] += 1
+            index = self.results_ctrl.FindItem(-1, port)
+            if index == wx.NOT_FOUND:
+                continue
+            if job.succeeded:
+                self.results_ctrl.SetItem(index, 1, "PASS")
+            else:
+                self.results_ctrl.SetItem(index, 1, "FAIL (%s)" % self.results_ctrl.GetItemText(index, 1))
+            self.results_ctrl.SetItemBackgroundColour(index, __pass_colour__ if job.succeeded else __fail_colour__)
+            self.statusBar.SetStatusText("Station mode: %d passed, %d failed" % tuple(self._station_counts), 0)
+        self._jobs = list(self._station_jobs.values())
+
+    def _jobs_running(self):
+        # a second click must not start another job on a port that is still busy
+        if any(job.is_alive() for job in self._jobs):
+            print("Jobs are still running, wait for them or cancel them first")
+            return True
+        return False
+
+    def _create_job(self, config):
+        if not config.use_processes:
+            return FlashingThread(self, config, self._session_pool)
+        # connections kept open by earlier jobs in this process would block the port for the worker processes
+        self._session_pool.close_all()
+        if self._worker_pool is None:
+            self._worker_pool = WorkerPool(self, self._get_cache_dir_path(), self._config.adapter_bauds,
+                                           max_workers=__max_worker_processes__)
+        return self._worker_pool.create_job(config)
+
     @staticmethod
     def _get_config_file_path():
-        return wx.StandardPaths.Get().GetUserConfigDir() + "/nodemcu-pyflasher.json"
+        return get_config_file_path()
+
+    @staticmethod
+    def _get_cache_dir_path():
+        return get_cache_dir_path()
 
     # Menu methods
     def _on_exit_app(self, event):
-        self._config.safe(self._get_config_file_path())
         self.Close(True)
 
+    def _on_close_window(self, event):
+        # File > Exit and the window's close button alike, running jobs in worker processes are cancelled or the
+        # process would live on without a window until they are finished
+        self._config.safe(self._get_config_file_path())
+        self._update_timer.Stop()
+        self._port_watcher.stop()
+        self._session_pool.close_all()
+        if self._worker_pool is not None:
+            self._worker_pool.close(wait=False)
+        self._catalog.close()
+        event.Skip()
+
+    def _on_index_folder(self, event):
+        dialog = wx.DirDialog(self, "Firmware folder", style=wx.DD_DIR_MUST_EXIST)
+        if dialog.ShowModal() == wx.ID_OK:
+            directory = dialog.GetPath()
+            # the first scan of a folder hashes every image, don't block the UI
+            threading.Thread(target=self._index_folder, args=(directory,), daemon=True).start()
+        dialog.Destroy()
+
+    def _index_folder(self, directory):
+        print("Indexing %s..." % directory)
+        try:
+            print("%d new or changed image(s) indexed" % self._catalog.scan(directory))
+        except OSError as e:
+            print("Indexing failed: %s" % e)
+
     def _on_help_about(self, event):
         from About import AboutDlg
         about = AboutDlg(self)
         about.ShowModal()
         about.Destroy()
 
-    def report_error(self, message):
-        self.console_ctrl.SetValue(message)
+    def _on_update_timer(self, event):
+        finished = [port for port, job in self._station_jobs.items() if not job.is_alive()]
+        for kind, payload in self._updates.drain():
+            try:
+                self._update_handlers[kind](payload)
+            except Exception as e:
+                # the batch is drained already, the updates after a bad one must not be lost
+                print("Failed to show a %s update: %s" % (kind, e))
+        if len(finished) > 0:
+            self._update_station(finished)
+        stats = self._updates.stats()
+        if stats.merged > 0 or stats.dropped > 0:
+            self.statusBar.SetStatusText("UI updates: %d merged, %d dropped" % (stats.merged, stats.dropped), 1)
+
+    def _update_ports(self, attached, detached):
+        # the first entries are auto-select, all Espressif devices and multiple ports, the ports follow sorted by name
+        fixed = 3
+        for info in detached:
+            index = self.choice.FindString(info.device)
+            if index != wx.NOT_FOUND and index >= fixed:
+                self.choice.Delete(index)
+            print("Device detached: %s" % info.device)
+            wx.PostEvent(self, DeviceDetachedEvent(port=info.device, info=info))
+        for info in attached:
+            if self.choice.FindString(info.device) == wx.NOT_FOUND:
+                # same natural order ("ttyUSB2" before "ttyUSB10") as pyserial sorts the ports in _get_serial_ports()
+                keys = [numsplit(port) for port in self.choice.GetItems()[fixed:]]
+                self.choice.Insert(info.device, fixed + bisect.bisect(keys, numsplit(info.device)))
+            print("Device attached: %s (%s)" % (info.device, info.description))
+            wx.PostEvent(self, DeviceAttachedEvent(port=info.device, info=info))
+        if self.choice.GetSelection() == wx.NOT_FOUND:
+            # the configured port may just have come back
+            self._select_configured_port()
+
+    def report_status(self, port, status):
+        self._updates.post("status", (port, status), key=port)
+
+    def _update_result(self, port, status):
+        index = self.results_ctrl.FindItem(-1, port)
+        if index == wx.NOT_FOUND:
+            index = self.results_ctrl.Append([port, status, ""])
+        self.results_ctrl.SetItem(index, 1, status)
+
+    def report_progress(self, port, event):
+        self._updates.post("progress", (port, event), key=port)
+
+    def _update_progress(self, port, event):
+        index = self.results_ctrl.FindItem(-1, port)
+        if index != wx.NOT_FOUND:
+            self.results_ctrl.SetItem(index, 2, format_progress(event))
+        if port == self._selected_job:
+            self.gauge.SetValue(1000 * event.done // event.total if event.total > 0 else 0)
+            self.statusBar.SetStatusText("%s: %s" % (port, format_progress(event)), 0)
+
+    def report_error(self, port, message):
+        self._updates.post("error", (port, message))
+
+    def _show_error(self, port, message):
+        # appended to the job's log, the esptool output before it shows what went wrong
+        self._console.write("\nError: %s\n" % message, port)
+
+    def report_timings(self, port, durations):
+        self._updates.post("timings", (port, dict(durations)), key=port)
+
+    def _show_timings(self, port, durations):
+        if port == self._selected_job:
+            self.statusBar.SetStatusText("%s: %s" % (port, format_timings(durations)), 0)
+
+    def output_sink(self, port):
+        return PostingStream(functools.partial(self._post_console, port))
+
+    def _post_console(self, source, string):
+        self._updates.post("console", (source, string))
 
     def log_message(self, message):
-        self.console_ctrl.AppendText(message)
+        self._console.write(message)
 
 # ---------------------------------------------------------------------------
 
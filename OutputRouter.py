@@ -0,0 +1,73 @@
+# coding=utf-8
+
+import contextlib
+import contextvars
+
+_sink = contextvars.ContextVar("output_sink", default=None)
+
+# ---------------------------------------------------------------------------
+
+
+# esptool prints to sys.stdout. This is installed there once and hands every write to the sink of the current
+# context, which every flashing thread sets for itself with route_output(). Writes outside any such context, e.g.
+# from the main thread or libraries, go to the default sink. Concurrent jobs thus never mix their output.
+class OutputRouter:
+    def __init__(self, default_sink):
+        self._default_sink = default_sink
+
+    def write(self, string):
+        self._current_sink().write(string)
+
+    def flush(self):
+        self._current_sink().flush()
+
+    def isatty(self):
+        return self._current_sink().isatty()
+
+    def _current_sink(self):
+        sink = _sink.get()
+        return self._default_sink if sink is None else sink
+
+
+@contextlib.contextmanager
+def route_output(sink):
+    token = _sink.set(sink)
+    try:
+        yield sink
+    finally:
+        _sink.reset(token)
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Writes complete lines prefixed with e.g. the port to a shared stream. Progress lines rewritten with a carriage
+# return are only written once they are final, as interleaving them with other output would be unreadable.
+class PrefixedStream:
+    def __init__(self, stream, prefix):
+        self._stream = stream
+        self._prefix = prefix
+        self._pending = ""
+
+    def write(self, string):
+        string = string.replace("\r\n", "\n")
+        segments = string.split("\n")
+        for index, segment in enumerate(segments):
+            carriage_return = segment.rfind("\r")
+            if carriage_return >= 0:
+                self._pending = segment[carriage_return + 1:]
+            else:
+                self._pending += segment
+            if index < len(segments) - 1:
+                self._stream.write("%s%s\n" % (self._prefix, self._pending))
+                self._pending = ""
+
+    def flush(self):
+        self._stream.flush()
+
+    # makes esptool rewrite progress lines with a carriage return, which are then collapsed here
+    # noinspection PyMethodMayBeStatic
+    def isatty(self):
+        return True
+
+# ---------------------------------------------------------------------------
@@ -0,0 +1,65 @@
+# coding=utf-8
+
+import collections
+import struct
+
+# where ESP-IDF (and the ESP8266 RTOS SDK) put the partition table unless the project configures another offset
+__partition_table_offset__ = 0x8000
+__partition_table_size__ = 0xC00
+__entry_format__ = "<2sBBLL16sL"
+__entry_size__ = struct.calcsize(__entry_format__)
+__entry_magic__ = b"\xAA\x50"
+__data_subtypes__ = {0x00: "ota", 0x01: "phy", 0x02: "nvs", 0x03: "coredump", 0x04: "nvs_keys", 0x05: "efuse",
+                     0x80: "esphttpd", 0x81: "fat", 0x82: "spiffs", 0x83: "littlefs"}
+__data_type__ = 0x01
+
+Partition = collections.namedtuple("Partition", ["label", "type", "subtype", "offset", "size"])
+
+# ---------------------------------------------------------------------------
+
+
+class PartitionTableError(Exception):
+    pass
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Parses a binary ESP-IDF partition table, e.g. partition-table.bin or what was read back from 0x8000. Returns an empty
+# list if the data doesn't start with a partition entry, e.g. erased flash.
+def parse_partition_table(data):
+    partitions = []
+    for start in range(0, len(data) - __entry_size__ + 1, __entry_size__):
+        entry = data[start:start + __entry_size__]
+        if entry[:2] != __entry_magic__:
+            # 0xFF padding after the last entry or the MD5 entry
+            break
+        magic, type_, subtype, offset, size, label, flags = struct.unpack(__entry_format__, entry)
+        partitions.append(Partition(label.rstrip(b"\x00").decode("ascii", "replace"), type_, subtype, offset, size))
+    return partitions
+
+
+# Finds a partition by label or, for data partitions, by subtype name such as "nvs" or "spiffs"
+def find_partition(partitions, name):
+    for partition in partitions:
+        if partition.label == name:
+            return partition
+    matches = [partition for partition in partitions
+               if partition.type == __data_type__ and __data_subtypes__.get(partition.subtype) == name]
+    if len(matches) > 1:
+        raise PartitionTableError("There are %d %s partitions (%s), name one by its label."
+                                  % (len(matches), name, ", ".join(partition.label for partition in matches)))
+    if len(matches) == 0:
+        raise PartitionTableError("The partition table has no partition named %s, it has %s."
+                                  % (name, ", ".join(partition.label for partition in partitions) or "none"))
+    return matches[0]
+
+
+# An erase region is a partition name or ADDRESS:SIZE, returns (address, size) or the name
+def parse_region(spec):
+    if ":" not in spec:
+        return spec.strip()
+    address, size = spec.split(":", 1)
+    return int(address, 0), int(size, 0)
+
+# ---------------------------------------------------------------------------
@@ -0,0 +1,72 @@
+# coding=utf-8
+
+import os
+import threading
+import time
+
+from serial.tools import list_ports
+
+__poll_interval__ = 0.5
+# device nodes of USB-serial adapters come and go in /dev, the ports are only listed again when its mtime changes
+__device_dir__ = "/dev"
+# ports are listed anyway after this many seconds, e.g. on Windows which has no /dev
+__rescan_interval__ = 5
+
+# ---------------------------------------------------------------------------
+
+
+# Watches for serial ports being plugged in and out in a background thread and reports the changes to a listener as
+# listener(attached, detached), lists of pyserial's ListPortInfo. The listener is called from the watcher's thread.
+# Checking /dev is a single stat() call, so ports can be polled often without listing them every time. A board
+# swapped on the same port name is reported as detached and attached if its adapter's hardware ID differs.
+class PortWatcher:
+    def __init__(self, listener, interval=__poll_interval__):
+        self._listener = listener
+        self._interval = interval
+        self._ports = {}
+        self._signature = None
+        self._scanned = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # the ports present now aren't reported
+        self._signature = self._device_dir_signature()
+        self._ports = self._list_ports()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _watch(self):
+        while not self._stop.wait(self._interval):
+            signature = self._device_dir_signature()
+            if signature == self._signature and time.time() - self._scanned < __rescan_interval__:
+                continue
+            self._signature = signature
+            ports = self._list_ports()
+            attached = [info for key, info in ports.items() if key not in self._ports]
+            detached = [info for key, info in self._ports.items() if key not in ports]
+            self._ports = ports
+            if len(attached) > 0 or len(detached) > 0:
+                try:
+                    self._listener(sorted(attached), sorted(detached))
+                except Exception as e:
+                    # a broken listener must not stop the watcher
+                    print("Port watcher: %s" % e)
+
+    def _list_ports(self):
+        self._scanned = time.time()
+        return {(info.device, info.hwid): info for info in list_ports.comports()}
+
+    @staticmethod
+    def _device_dir_signature():
+        try:
+            return os.stat(__device_dir__).st_mtime_ns
+        except OSError:
+            return None
+
+# ---------------------------------------------------------------------------
@@ -0,0 +1,97 @@
+# coding=utf-8
+
+import collections
+import contextlib
+import time
+
+# done and total are bytes (0 if the phase has no meaningful size), eta is in seconds or None if unknown
+ProgressEvent = collections.namedtuple("ProgressEvent", ["phase", "done", "total", "bytes_per_second", "eta"])
+
+# ---------------------------------------------------------------------------
+
+
+# Turns the phases and byte counts reported by a session into ProgressEvents for a listener, e.g. the UI
+class ProgressTracker:
+    def __init__(self, listener=None):
+        self.listener = listener
+        self._phase = None
+        self._done = 0
+        self._total = 0
+        self._started = 0
+
+    def begin(self, phase, total=0):
+        self._phase = phase
+        self._done = 0
+        self._total = total
+        self._started = time.time()
+        self._emit()
+
+    def advance(self, count):
+        self._done += count
+        self._emit()
+
+    def finish(self):
+        self._done = self._total
+        self._emit()
+
+    def snapshot(self):
+        # ProgressEvent of the current phase, e.g. to report how far a cancelled job got
+        elapsed = time.time() - self._started
+        bytes_per_second = self._done / elapsed if elapsed > 0 else 0
+        eta = None
+        if bytes_per_second > 0 and self._total > 0:
+            eta = (self._total - self._done) / bytes_per_second
+        return ProgressEvent(self._phase, self._done, self._total, bytes_per_second, eta)
+
+    def _emit(self):
+        if self.listener is None:
+            return
+        self.listener(self.snapshot())
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Wall-clock time spent per phase of a session, e.g. to tell a slow cable or adapter from a slow erase
+class PhaseTimer:
+    def __init__(self):
+        self.durations = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def measure(self, phase):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.durations[phase] = self.durations.get(phase, 0) + time.time() - started
+
+    def add(self, durations):
+        # durations measured by another timer, e.g. of a connection that broke
+        for phase, duration in durations.items():
+            self.durations[phase] = self.durations.get(phase, 0) + duration
+
+    def reset(self):
+        self.durations = collections.OrderedDict()
+
+    def total(self):
+        return sum(self.durations.values())
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+def format_progress(event):
+    if event.total == 0:
+        return event.phase
+    text = "%s %d%%" % (event.phase, 100 * event.done // event.total)
+    if event.bytes_per_second > 0:
+        text += ", %.1f KB/s" % (event.bytes_per_second / 1024)
+    if event.eta is not None:
+        text += ", ETA %d:%02d" % divmod(int(event.eta + 0.5), 60)
+    return text
+
+
+def format_timings(durations):
+    return ", ".join("%s %.2fs" % (phase.replace("_", " "), duration) for phase, duration in durations.items())
+
+# ---------------------------------------------------------------------------
@@ -0,0 +1,91 @@
+# coding=utf-8
+
+import collections
+import itertools
+import threading
+
+__default_max_pending__ = 5000
+# kinds of updates whose (source, text) payloads are concatenated when posted back to back from the same source
+__mergeable_kinds__ = ["console"]
+
+ChannelStats = collections.namedtuple("ChannelStats", ["posted", "delivered", "merged", "dropped"])
+
+# ---------------------------------------------------------------------------
+
+
+# Thread-safe hand-over of updates from worker threads to the UI, which drains it in batches from a timer instead of
+# receiving one event per update. Pending updates with the same key are replaced by the newest one (e.g. the status
+# of a port) and console text posted back to back by the same source is concatenated. If the UI falls behind by more
+# than max_pending updates the oldest ones are dropped.
+class UpdateChannel:
+    def __init__(self, max_pending=__default_max_pending__):
+        self._pending = collections.OrderedDict()
+        self._max_pending = max_pending
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._posted = 0
+        self._delivered = 0
+        self._merged = 0
+        self._dropped = 0
+
+    def post(self, kind, payload, key=None):
+        with self._lock:
+            self._posted += 1
+            if key is not None:
+                key = (kind, key)
+                if key in self._pending:
+                    self._merged += 1
+                    del self._pending[key]
+                self._pending[key] = (kind, payload)
+            elif kind in __mergeable_kinds__ and self._can_merge(kind, payload[0]):
+                last_key = next(reversed(self._pending))
+                source, text = self._pending[last_key][1]
+                self._pending[last_key] = (kind, (source, text + payload[1]))
+                self._merged += 1
+            else:
+                self._pending[next(self._sequence)] = (kind, payload)
+            while len(self._pending) > self._max_pending:
+                self._pending.popitem(last=False)
+                self._dropped += 1
+
+    def _can_merge(self, kind, source):
+        if len(self._pending) == 0:
+            return False
+        last_kind, last_payload = self._pending[next(reversed(self._pending))]
+        return last_kind == kind and last_payload[0] == source
+
+    def drain(self):
+        with self._lock:
+            updates = list(self._pending.values())
+            self._pending.clear()
+            self._delivered += len(updates)
+        return updates
+
+    def stats(self):
+        with self._lock:
+            return ChannelStats(self._posted, self._delivered, self._merged, self._dropped)
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# File-like object handing everything written to it to post(string), e.g. as console updates of a port to an
+# UpdateChannel or as events to the WorkerPool's queue
+class PostingStream:
+    def __init__(self, post):
+        self._post = post
+
+    def write(self, string):
+        self._post(string)
+
+    # noinspection PyMethodMayBeStatic
+    def flush(self):
+        # noinspection PyStatementEffect
+        None
+
+    # esptool >=3 handles output differently if the output stream is not a TTY
+    # noinspection PyMethodMayBeStatic
+    def isatty(self):
+        return True
+
+# ---------------------------------------------------------------------------
@@ -0,0 +1,214 @@
+# coding=utf-8
+
+import functools
+import itertools
+import multiprocessing
+import signal
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.managers import SyncManager
+
+from EspSession import SessionPool
+from FirmwareCache import FirmwareCache
+from Flasher import FlashingThread, claim_port, release_port
+from OutputRouter import OutputRouter
+from UpdateChannel import PostingStream
+
+# set in every worker process by _init_worker()
+_events = None
+_cache_dir = None
+
+# ---------------------------------------------------------------------------
+
+
+# Runs flash jobs in a pool of worker processes so that compression, SLIP framing and checksums neither compete with
+# the UI for the GIL nor limit concurrent jobs to one core. Worker processes report back through a single event queue
+# (a pipe underneath), which one thread in this process reads and hands to the parent, e.g. the GUI frame, through
+# the same report_*() and output_sink() methods a FlashingThread uses.
+# Connections are not kept between jobs as the next job for a port may run in another process.
+class WorkerPool:
+    def __init__(self, parent, cache_dir, baud_memory, max_workers=None):
+        self._parent = parent
+        # negotiated baud rates by adapter, workers report back what they found
+        self._baud_memory = baud_memory
+        # spawn rather than fork, forking a process running wx (or any other threads) isn't safe
+        context = multiprocessing.get_context("spawn")
+        self._events = context.Queue()
+        # cancel events have to be shared with the worker processes, plain multiprocessing events can't be passed
+        # to a job once the pool runs
+        self._manager = SyncManager(ctx=context)
+        self._manager.start(_ignore_interrupts)
+        self._executor = ProcessPoolExecutor(max_workers, mp_context=context, initializer=_init_worker,
+                                             initargs=(self._events, cache_dir))
+        self._jobs = {}
+        self._job_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def create_job(self, config):
+        with self._lock:
+            job = FlashingProcess(self, next(self._job_ids), self._parent, config, self._manager.Event())
+            self._jobs[job.job_id] = job
+        return job
+
+    def _submit(self, job):
+        future = self._executor.submit(_run_job, job.job_id, job.config, job.cancel_event)
+        future.add_done_callback(job.handle_result)
+        return future
+
+    def _dispatch(self):
+        while True:
+            job_id, kind, payload = self._events.get()
+            if kind is None:
+                break
+            with self._lock:
+                job = self._jobs.get(job_id)
+            if job is not None:
+                job.handle_event(kind, payload)
+
+    def _finished(self, job, adapter_bauds):
+        self._baud_memory.update(adapter_bauds)
+        release_port(job.config.port)
+        with self._lock:
+            self._jobs.pop(job.job_id, None)
+
+    def close(self, wait=True):
+        # waits for running jobs unless told otherwise, jobs that haven't started yet are dropped. Running jobs are
+        # cancelled if not waited for, the interpreter waits for the worker processes on exit anyway and they only
+        # stop at their next block boundary that way.
+        if not wait:
+            with self._lock:
+                jobs = list(self._jobs.values())
+            for job in jobs:
+                if job.is_alive():
+                    job.cancel()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+        self._events.put((None, None, None))
+        if wait:
+            self._manager.shutdown()
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Stands in for a FlashingThread (start(), join(), succeeded) while the job runs in one of the pool's processes
+class FlashingProcess:
+    def __init__(self, pool, job_id, parent, config, cancel_event):
+        self.job_id = job_id
+        self.config = config
+        self.cancel_event = cancel_event
+        self.succeeded = False
+        self._pool = pool
+        self._parent = parent
+        self._sink = None
+        self._future = None
+        self._done = threading.Event()
+
+    def start(self):
+        if not claim_port(self.config.port):
+            self._parent.report_status(self.config.port, "Failed: another job is using %s" % self.config.port)
+            self._done.set()
+            return
+        self._sink = self._parent.output_sink(self.config.port)
+        self._future = self._pool._submit(self)
+
+    def cancel(self):
+        # a job still waiting for a worker is dropped, a running one stops at the next block boundary
+        if self._future is not None and self._future.cancel():
+            return
+        self.cancel_event.set()
+
+    def is_alive(self):
+        return not self._done.is_set()
+
+    def join(self, timeout=None):
+        self._done.wait(timeout)
+
+    def handle_event(self, kind, payload):
+        port = self.config.port
+        if kind == "console":
+            self._sink.write(payload)
+        elif kind == "status":
+            self._parent.report_status(port, payload)
+        elif kind == "progress":
+            self._parent.report_progress(port, payload)
+        elif kind == "timings":
+            self._parent.report_timings(port, payload)
+        elif kind == "error":
+            self._parent.report_error(port, payload)
+        elif kind == "finished":
+            self.succeeded, adapter_bauds = payload
+            self._pool._finished(self, adapter_bauds)
+            self._done.set()
+
+    def handle_result(self, future):
+        # the job reports its own failures, this only catches worker processes that died or never ran the job
+        if future.cancelled():
+            status = "Cancelled: the job hadn't started"
+        elif future.exception() is not None:
+            status = "Failed: %s" % future.exception()
+        else:
+            return
+        self._parent.report_status(self.config.port, status)
+        self._pool._finished(self, {})
+        self._done.set()
+
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# What a FlashingThread in a worker process reports to, everything is posted to the event queue
+class _EventReporter:
+    def __init__(self, job_id):
+        self._job_id = job_id
+
+    def _post(self, kind, payload):
+        _events.put((self._job_id, kind, payload))
+
+    def report_status(self, port, status):
+        self._post("status", status)
+
+    def report_progress(self, port, event):
+        self._post("progress", event)
+
+    def report_timings(self, port, durations):
+        self._post("timings", dict(durations))
+
+    def report_error(self, port, message):
+        self._post("error", message)
+
+    def output_sink(self, port):
+        return PostingStream(functools.partial(self._post, "console"))
+
+
+def _ignore_interrupts():
+    # Ctrl+C reaches every process of the group, this one leaves it to the parent to cancel the jobs
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _init_worker(events, cache_dir):
+    global _events, _cache_dir
+    _events = events
+    _cache_dir = cache_dir
+    _ignore_interrupts()
+    sys.stdout = OutputRouter(sys.__stdout__)
+
+
+def _run_job(job_id, config, cancel_event):
+    reporter = _EventReporter(job_id)
+    baud_memory = dict(config.adapter_bauds)
+    session_pool = SessionPool(FirmwareCache(_cache_dir), baud_memory)
+    worker = FlashingThread(reporter, config, session_pool, cancel_event)
+    try:
+        # runs the job in this process' main thread rather than starting the thread
+        worker.run()
+    except Exception:
+        # already reported by the job
+        pass
+    finally:
+        session_pool.close_all()
+        reporter._post("finished", (worker.succeeded, baud_memory))
+
+# ---------------------------------------------------------------------------
@@ -1,4 +1,20 @@
 #!/usr/bin/env python
 
-import Main
-Main.main()
+import multiprocessing
+import os
+import sys
+
+# guarded as worker processes (see WorkerPool) re-import this module
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    # --headless selects the headless mode which must not load wx. Other arguments, e.g. a file dropped onto the
+    # executable, still open the GUI.
+    if "--headless" in sys.argv[1:]:
+        if sys.stdout is None or sys.stderr is None:
+            # the GUI builds have no console, the exit status is all a script gets from them
+            sys.stdout = sys.stderr = open(os.devnull, "w")
+        import Headless
+        sys.exit(Headless.main([arg for arg in sys.argv[1:] if arg != "--headless"]))
+    else:
+        import Main
+        Main.main()